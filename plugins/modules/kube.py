@@ -6,7 +6,7 @@ DOCUMENTATION = """
 module: kube
 short_description: Manage Kubernetes Cluster
 description:
-  - Create, replace, remove, and stop resources within a Kubernetes Cluster
+  - Create, replace, remove, and scale resources within a Kubernetes Cluster
 version_added: "2.0"
 options:
   name:
@@ -21,6 +21,17 @@ options:
       - The path and filename of the resource(s) definition file(s).
       - To operate on several files this can accept a comma separated list of files or a list of files.
     aliases: [ 'files', 'file', 'filenames' ]
+  definition:
+    required: false
+    default: null
+    description:
+      - The resource(s) definition given inline instead of in a file, as YAML or JSON
+        text (for instance from the template lookup) or as a dict or a list of dicts.
+      - The definition is never written to disk, kubectl reads it from stdin.
+      - Fingerprints of a definition are keyed by the kind, namespace and name of the
+        objects it defines. Cannot be used with chunk_size.
+      - Mutually exclusive with filename and resource.
+    aliases: [ 'content' ]
   kubectl:
     required: false
     default: null
@@ -55,7 +66,7 @@ options:
     required: false
     default: false
     description:
-      - A flag to indicate to force delete, replace, or stop.
+      - A flag to indicate to force delete or replace.
   wait:
     required: false
     default: false
@@ -65,7 +76,7 @@ options:
     required: false
     default: false
     description:
-      - A flag to indicate delete all, stop all, or all namespaces when checking exists.
+      - A flag to indicate delete all, or all namespaces when scaling or checking exists.
   log_level:
     required: false
     default: 0
@@ -73,14 +84,15 @@ options:
       - Indicates the level of verbosity of logging by kubectl.
   state:
     required: false
-    choices: ['present', 'absent', 'latest', 'reloaded', 'stopped']
+    choices: ['present', 'absent', 'latest', 'reloaded', 'scaled', 'exists', 'discovered']
     default: present
     description:
       - present handles checking existence or creating if definition file provided,
         absent handles deleting resource(s) based on other options,
         latest handles creating or updating based on existence,
         reloaded handles updating resource(s) definition using definition file,
-        stopped handles stopping resource(s) based on other options.
+        scaled handles scaling the workloads selected by the other options to replicas,
+        discovered fills the discovery cache in cache_dir for the next tasks.
   recursive:
     required: false
     default: false
@@ -88,8 +100,171 @@ options:
       - Process the directory used in -f, --filename recursively.
         Useful when you want to manage related manifests organized
         within the same directory.
+  engine:
+    required: false
+    choices: ['kubectl', 'api']
+    default: kubectl
+    description:
+      - kubectl runs a kubectl process for every operation.
+        api talks to the API server directly over a pooled HTTP(S) connection
+        using the credentials from the kubeconfig, without running kubectl.
+      - Without server_side, the api engine updates objects with a JSON merge patch,
+        not with the strategic merge patch of kubectl apply. Lists such as containers,
+        env, volumes or tolerations are replaced as a whole, dropping the entries other
+        field managers added to them. Use server_side to have lists merged by key.
+  fingerprint:
+    required: false
+    choices: ['none', 'file', 'annotation']
+    default: none
+    description:
+      - Skip applying manifests that did not change since they were last applied
+        with present, latest or reloaded. Each manifest file is hashed together with the namespace,
+        the cluster (server and kubeconfig) and the apply options (server_side, field_manager,
+        prune, applyset and force).
+        file records the hashes in fingerprint_file on the host running the module,
+        which makes the check free but does not notice objects changed or removed in the cluster.
+        annotation records the hash in a kubespray.io/manifest-sha256 annotation on the
+        applied objects, and only skips the apply if every object still carries it.
+      - The fingerprint is only recorded once wait_for is satisfied, and with wait_for=ready
+        the objects of skipped manifests are still waited for.
+  fingerprint_file:
+    required: false
+    default: ~/.kube/kubespray-fingerprints.json
+    description:
+      - The state file used with fingerprint=file.
+  wait_for:
+    required: false
+    choices: ['none', 'ready']
+    default: none
+    description:
+      - With ready, once the manifests are applied, watch the Deployments, DaemonSets,
+        StatefulSets, Jobs and CustomResourceDefinitions they contain until they are
+        rolled out, complete or established. All objects are watched concurrently and
+        the time each one took to become ready is returned in C(readiness).
+  wait_timeout:
+    required: false
+    default: 300
+    description:
+      - How long to wait, in seconds, for wait_for=ready, for a bulk delete or for
+        state=scaled.
+  parallel:
+    required: false
+    default: 8
+    description:
+      - The maximum number of concurrent operations, for instance objects waited for
+        or kubectl apply commands run with phased=true.
+  phased:
+    required: false
+    default: false
+    description:
+      - Apply the objects of the manifests in phases instead of in file order.
+        Namespaces and CustomResourceDefinitions are applied first, then once the
+        CustomResourceDefinitions are established all the other objects are applied
+        concurrently, split between up to parallel workers.
+        Requires PyYAML, also with engine=kubectl.
+  replicas:
+    required: false
+    default: null
+    description:
+      - The number of replicas for state=scaled. Every Deployment, StatefulSet,
+        ReplicaSet and ReplicationController selected by filename, definition, name,
+        label or all, one of which is required, is scaled at once; with wait, the task
+        then waits within wait_timeout until all of them run that number of ready replicas.
+  bulk:
+    required: false
+    default: false
+    description:
+      - With state=absent, delete every object at once with background propagation
+        instead of waiting for each object to be gone in turn. With wait, then wait
+        for all of them to be gone within wait_timeout, so the task takes as long as
+        the slowest object rather than the sum of all of them.
+  server_side:
+    required: false
+    default: false
+    description:
+      - Use server side apply instead of client side apply. The API server merges
+        the manifests, no last-applied-configuration annotation is sent, and
+        objects are never deleted and re-created to resolve a conflict.
+      - kubectl reports every object as serverside-applied, so with engine=kubectl
+        the task reports changed whenever the manifests are applied.
+  field_manager:
+    required: false
+    default: kubespray
+    description:
+      - The field manager owning the fields set with server_side.
+  force_conflicts:
+    required: false
+    default: true
+    description:
+      - With server_side, take ownership of the fields set by other field managers
+        instead of failing on conflicts.
+  prune:
+    required: false
+    default: false
+    description:
+      - Delete the objects which were applied as part of the applyset but are no
+        longer in the manifests. Cannot be used with phased or chunk_size.
+  applyset:
+    required: false
+    default: null
+    description:
+      - The parent object of the ApplySet used with prune, as [RESOURCE/]NAME where
+        RESOURCE is secret (the default) or configmap, in the namespace given to the module.
+      - The api engine records kubespray/v1 as the ApplySet tooling, kubectl refuses to
+        manage an ApplySet created by another tool: keep using the same engine for an applyset.
+  cache_dir:
+    required: false
+    default: ~/.kube/cache
+    description:
+      - Directory of the API discovery cache shared by every invocation of the module
+        on the host. Given to kubectl with --cache-dir, the api engine keeps its own
+        discovery cache in the kubespray subdirectory.
+  cache_ttl:
+    required: false
+    default: null
+    description:
+      - How long, in seconds, the discovery cache in cache_dir is used before the
+        resources are discovered again. 0 disables the discovery cache.
+      - The api engine uses 600 when unset. With engine=kubectl, the discovery and
+        OpenAPI caches of kubectl are only expired when cache_ttl is set, otherwise
+        kubectl expires them on its own.
+      - Resources not found in the cache, such as those of a CRD created in the
+        meantime, are always discovered again.
+  chunk_size:
+    required: false
+    default: 0
+    description:
+      - When set, read the documents of each manifest lazily and apply them
+        chunk_size documents at a time instead of sending whole files at once,
+        keeping requests small and memory bounded for very large manifests.
+      - The chunks applied are recorded in checkpoint_file, so that a retry of a task
+        which failed halfway through resumes at the failed chunk, as long as the manifest
+        did not change.
+      - Mutually exclusive with phased.
+  checkpoint_file:
+    required: false
+    default: ~/.kube/kubespray-checkpoints.json
+    description:
+      - The state file used to record progress with chunk_size.
+  items:
+    required: false
+    default: null
+    description:
+      - A list of operations to run in a single invocation of the module.
+        Each entry takes the filename, definition, resource, name, label, namespace, state,
+        replicas, force, wait, wait_for, all and recursive options. filename, definition, resource, name
+        and label are only taken from the entry, the other options default to the value given
+        to the module.
+      - Per entry results and durations are returned in C(items).
+      - Mutually exclusive with filename and resource.
+notes:
+  - The wall time, exit code or HTTP status and byte counts of every kubectl command
+    or API request run by the module are returned in C(timings). When the
+    KUBESPRAY_KUBE_TIMINGS_FILE environment variable is set on the host running the
+    module, they are also appended to that file as JSON lines.
 requirements:
-  - kubectl
+  - kubectl (engine=kubectl)
+  - PyYAML (engine=api, phased=true or definition with fingerprint=file)
 author: "Kenny Jones (@kenjones-cisco)"
 """
 
@@ -97,8 +272,8 @@ EXAMPLES = """
 - name: test nginx is present
   kube: name=nginx resource=rc state=present
 
-- name: test nginx is stopped
-  kube: name=nginx resource=rc state=stopped
+- name: test nginx is scaled down
+  kube: name=nginx resource=rc state=scaled replicas=0
 
 - name: test nginx is absent
   kube: name=nginx resource=rc state=absent
@@ -114,14 +289,671 @@ EXAMPLES = """
     files:
       - /tmp/nginx.yml
       - /tmp/postgresql.yml
+
+- name: test metallb is rolled out
+  kube:
+    filename: /tmp/metallb.yml
+    state: latest
+    wait_for: ready
+    wait_timeout: 120
+
+- name: test argocd is present, CRDs first then everything else concurrently
+  kube:
+    filename: /tmp/argocd-install.yml
+    namespace: argocd
+    state: latest
+    phased: true
+    parallel: 8
+
+- name: test ingress-nginx is present, removing objects dropped from the manifest
+  kube:
+    filename: /tmp/ingress-nginx.yml
+    namespace: ingress-nginx
+    state: latest
+    server_side: true
+    prune: true
+    applyset: ingress-nginx
+
+- name: test the addons are removed, waiting for all of them at once
+  kube:
+    filename: /etc/kubernetes/addons
+    recursive: true
+    state: absent
+    force: true
+    bulk: true
+    wait: true
+    wait_timeout: 600
+
+- name: test the coredns addon is present, without rendering it to disk first
+  kube:
+    definition: "{{ lookup('template', 'coredns-deployment.yml.j2') }}"
+    namespace: kube-system
+    state: latest
+    fingerprint: annotation
+
+- name: discover the API resources once, for the next kube tasks
+  kube:
+    state: discovered
+    cache_ttl: 3600
+
+- name: drain the addons before the upgrade, all of them at once
+  kube:
+    resource: deploy
+    label: kubespray.io/addon=true
+    all: true
+    state: scaled
+    replicas: 0
+    wait: true
+
+- name: test several resources in one task
+  kube:
+    kubectl: /usr/local/bin/kubectl
+    namespace: metallb-system
+    items:
+      - filename: /tmp/metallb.yml
+        state: latest
+      - filename: /tmp/pools.yml
+      - resource: ConfigMap
+        name: config
+        state: absent
+
+- name: test nginx is present, without running kubectl
+  kube:
+    filename: /tmp/nginx.yml
+    kubeconfig: /etc/kubernetes/admin.conf
+    engine: api
 """
 
 
+import base64
+import copy
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlparse
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+# Extensions kubectl considers when --filename points to a directory
+MANIFEST_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+# When set, the timings of every invocation are appended to this file as JSON lines
+TIMINGS_FILE_ENV = 'KUBESPRAY_KUBE_TIMINGS_FILE'
+
+# Kinds applied before any other object with phased=true
+FIRST_KINDS = ('Namespace', 'CustomResourceDefinition')
+
+# Kinds state=scaled scales
+SCALE_KINDS = ('Deployment', 'StatefulSet', 'ReplicaSet', 'ReplicationController')
+
+# Kinds wait_for=ready waits for
+READY_KINDS = ('Deployment', 'DaemonSet', 'StatefulSet', 'Job', 'CustomResourceDefinition')
+
+LAST_APPLIED_ANNOTATION = 'kubectl.kubernetes.io/last-applied-configuration'
+
+# Ask the API server for object metadata only, falling back to whole objects
+METADATA_ACCEPT = 'application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json'
+METADATA_LIST_ACCEPT = 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json'
+
+# ApplySet labels and annotations, see https://kubernetes.io/docs/tasks/manage-kubernetes-objects/declarative-config/
+APPLYSET_ID_LABEL = 'applyset.kubernetes.io/id'
+APPLYSET_PART_OF_LABEL = 'applyset.kubernetes.io/part-of'
+APPLYSET_TOOLING_ANNOTATION = 'applyset.kubernetes.io/tooling'
+APPLYSET_GROUP_KINDS_ANNOTATION = 'applyset.kubernetes.io/contains-group-kinds'
+APPLYSET_NAMESPACES_ANNOTATION = 'applyset.kubernetes.io/additional-namespaces'
+APPLYSET_TOOLING = 'kubespray/v1'
+
+# Records the fingerprint of the manifests an object was applied from
+FINGERPRINT_ANNOTATION = 'kubespray.io/manifest-sha256'
+
+# Seconds the api engine uses its discovery cache when cache_ttl is not set
+DEFAULT_CACHE_TTL = 600
+
+# Methods sent again when a request fails without a response, see KubeApiClient.request
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class KubeApiError(Exception):
+    """An error response of the API server, or with status None, no response at all."""
+
+    def __init__(self, method, path, status, reason, body):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.reason = reason
+        self.body = body
+        if status is None:
+            super(KubeApiError, self).__init__('%s %s failed: %s' % (method, path, reason))
+            return
+        try:
+            message = json.loads(body).get('message') or reason
+        except ValueError:
+            message = body or reason
+        super(KubeApiError, self).__init__(
+            '%s %s failed (status=%d): %s' % (method, path, status, message))
+
+
+class KubeApiClient(object):
+    """Minimal Kubernetes API client reusing a pool of keep-alive connections."""
+
+    def __init__(self, module, kubeconfig=None, server=None, pool_size=4, timeout=60, timings=None,
+                 cache_dir=None, cache_ttl=0):
+
+        self.module = module
+        self.timings = [] if timings is None else timings
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = {'User-Agent': 'kubespray-kube-module'}
+        self.namespace = 'default'
+        self._idle = []
+        self._lock = threading.Lock()
+        self._discovery = {}
+        self._preferred = None
+        self._all_resources = None
+        self._tmpfiles = []
+        self._cache_file = None
+        self._cached = False
+        self._cache_dirty = False
+        self._cache_time = time.time()
+
+        cluster, user = self._load_kubeconfig(kubeconfig)
+        if server:
+            cluster['server'] = server
+        if not cluster.get('server'):
+            module.fail_json(msg='no API server found in kubeconfig, set server or kubeconfig')
+
+        url = urlparse(cluster['server'])
+        self.scheme = url.scheme or 'https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.scheme == 'https' else 80)
+        self.base_path = url.path.rstrip('/')
+        self.ssl_context = None
+        if self.scheme == 'https':
+            self.ssl_context = self._ssl_context(cluster, user)
+
+        if cache_dir and cache_ttl > 0:
+            self._cache_file = os.path.join(cache_dir, 'kubespray',
+                                            'discovery-%s_%d.json' % (self.host, self.port))
+            self._load_discovery(cache_ttl)
+
+        if user.get('token'):
+            self.headers['Authorization'] = 'Bearer ' + user['token']
+        elif user.get('tokenFile'):
+            with open(user['tokenFile']) as token_file:
+                self.headers['Authorization'] = 'Bearer ' + token_file.read().strip()
+        elif user.get('username'):
+            credentials = '%s:%s' % (user['username'], user.get('password', ''))
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+
+    def _load_kubeconfig(self, kubeconfig):
+        path = kubeconfig
+        if not path:
+            path = (os.environ.get('KUBECONFIG') or '').split(os.pathsep)[0] or \
+                os.path.expanduser('~/.kube/config')
+        if not os.path.exists(path):
+            if kubeconfig:
+                self.module.fail_json(msg='kubeconfig %s does not exist' % kubeconfig)
+            return {}, {}
+
+        with open(path) as config_file:
+            config = yaml.safe_load(config_file) or {}
+
+        def named(section, name):
+            for entry in config.get(section) or []:
+                if entry.get('name') == name:
+                    return dict(entry.get(section[:-1]) or {})
+            return {}
+
+        context = named('contexts', config.get('current-context'))
+        cluster = named('clusters', context.get('cluster'))
+        user = named('users', context.get('user'))
+        if context.get('namespace'):
+            self.namespace = context['namespace']
+
+        # Paths in a kubeconfig are relative to the kubeconfig itself
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for section, key in ((cluster, 'certificate-authority'), (user, 'client-certificate'),
+                             (user, 'client-key'), (user, 'tokenFile')):
+            if section.get(key):
+                section[key] = os.path.join(base_dir, section[key])
+        return cluster, user
+
+    def _tmpfile(self, data):
+        fd, path = tempfile.mkstemp(dir=self.module.tmpdir)
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(base64.b64decode(data))
+        self._tmpfiles.append(path)
+        return path
+
+    def _ssl_context(self, cluster, user):
+        context = ssl.create_default_context()
+        if cluster.get('insecure-skip-tls-verify'):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif cluster.get('certificate-authority-data'):
+            context.load_verify_locations(
+                cadata=base64.b64decode(cluster['certificate-authority-data']).decode())
+        elif cluster.get('certificate-authority'):
+            context.load_verify_locations(cafile=cluster['certificate-authority'])
+
+        cert = user.get('client-certificate')
+        key = user.get('client-key')
+        if user.get('client-certificate-data'):
+            cert = self._tmpfile(user['client-certificate-data'])
+        if user.get('client-key-data'):
+            key = self._tmpfile(user['client-key-data'])
+        if cert:
+            context.load_cert_chain(cert, key)
+        return context
+
+    def _load_discovery(self, ttl):
+        try:
+            with open(self._cache_file) as cache:
+                cached = json.load(cache)
+        except (IOError, ValueError):
+            return
+        if time.time() - cached.get('time', 0) >= ttl:
+            return
+        self._discovery = cached.get('resources') or {}
+        self._preferred = cached.get('preferred')
+        self._cache_time = cached['time']
+        self._cached = True
+
+    def _save_discovery(self):
+        directory = os.path.dirname(self._cache_file)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Invocations on the same host share the file, replace it atomically
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(dict(time=self._cache_time, preferred=self._preferred, resources=self._discovery),
+                      tmp_file)
+        os.rename(tmp, self._cache_file)
+
+    def close(self):
+        if self._cache_file and self._cache_dirty:
+            self._save_discovery()
+            self._cache_dirty = False
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+        for path in self._tmpfiles:
+            if os.path.exists(path):
+                os.remove(path)
+        self._tmpfiles = []
+
+    def _connect(self, timeout):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _acquire(self):
+        """Return a connection, and whether it was used before."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, query=None,
+                content_type='application/json', accept='application/json'):
+        url = self.base_path + path
+        if query:
+            url += '?' + urlencode(query)
+        headers = dict(self.headers, Accept=accept)
+        if body is not None:
+            if not isinstance(body, bytes):
+                body = json.dumps(body, default=str).encode()
+            headers['Content-Type'] = content_type
+
+        start = time.time()
+        for attempt in (1, 2):
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, socket.error) as exc:
+                conn.close()
+                # A pooled keep-alive connection may have been closed by the server. After
+                # a timeout the server may have handled the request: only send it again if
+                # that is harmless.
+                if attempt == 1 and reused and (method in IDEMPOTENT_METHODS or
+                                                not isinstance(exc, socket.timeout)):
+                    continue
+                self._record(start, method, path, None, len(body or b''), 0)
+                raise KubeApiError(method, path, None, str(exc) or type(exc).__name__, '')
+            self._release(conn)
+            break
+        self._record(start, method, path, response.status, len(body or b''), len(data))
+
+        if response.status >= 400:
+            raise KubeApiError(method, path, response.status, response.reason,
+                               data.decode('utf-8', 'replace'))
+        if not data:
+            return None
+        return json.loads(data)
+
+    def watch(self, path, query, timeout):
+        """Yield the events of a watch on the collection at path, until the server ends it
+        after timeout seconds. Watches use their own connection, outside of the pool."""
+        query = dict(query, watch='true', timeoutSeconds=max(1, int(timeout)))
+        conn = self._connect(timeout + self.timeout)
+        start = time.time()
+        response = None
+        received = 0
+        try:
+            conn.request('GET', self.base_path + path + '?' + urlencode(query),
+                         headers=dict(self.headers, Accept='application/json'))
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise KubeApiError('GET', path, response.status, response.reason,
+                                   response.read().decode('utf-8', 'replace'))
+            for line in response:
+                received += len(line)
+                if line.strip():
+                    yield json.loads(line)
+        except (http.client.HTTPException, socket.error) as exc:
+            raise KubeApiError('WATCH', path, None, str(exc) or type(exc).__name__, '')
+        finally:
+            conn.close()
+            self._record(start, 'WATCH', path, response.status if response else None, 0, received)
+
+    def _record(self, start, method, path, status, sent, received):
+        self.timings.append(dict(command='%s %s' % (method, path), status=status, start=start,
+                                 seconds=round(time.time() - start, 4),
+                                 request_bytes=sent, response_bytes=received))
+
+    @staticmethod
+    def group_version_path(api_version):
+        if '/' in api_version:
+            return '/apis/' + api_version
+        return '/api/' + api_version
+
+    def _group_version_resources(self, api_version, refresh=False):
+        if refresh or api_version not in self._discovery:
+            resources = {}
+            listing = self.request('GET', self.group_version_path(api_version))
+            for res in listing.get('resources', []):
+                if '/' in res['name']:
+                    continue
+                resources[res['kind']] = {
+                    'name': res['name'],
+                    'kind': res['kind'],
+                    'singular': res.get('singularName') or res['kind'].lower(),
+                    'short_names': res.get('shortNames') or [],
+                    'namespaced': res['namespaced'],
+                    'api_version': api_version,
+                }
+            self._discovery[api_version] = resources
+            self._cache_dirty = True
+        return self._discovery[api_version]
+
+    def resource_for(self, api_version, kind):
+        """Look up the resource serving kind in the api_version group version."""
+        # Discover again on a miss, the kind may come from a CRD created in the meantime
+        for refresh in (False, True):
+            try:
+                resources = self._group_version_resources(api_version, refresh)
+            except KubeApiError as exc:
+                if exc.status != 404:
+                    raise
+                resources = {}
+            if kind in resources:
+                return resources[kind]
+        raise KubeApiError('GET', self.group_version_path(api_version), 404, 'NotFound',
+                           'the server does not know the kind %s in %s' % (kind, api_version))
+
+    def _preferred_group_versions(self):
+        if self._preferred is None:
+            self._preferred = ['v1']
+            for group in self.request('GET', '/apis').get('groups', []):
+                self._preferred.append(group['preferredVersion']['groupVersion'])
+            self._cache_dirty = True
+        return self._preferred
+
+    def discover(self):
+        """Discover every resource served in the preferred group versions."""
+        if self._all_resources is None:
+            self._all_resources = []
+            for api_version in self._preferred_group_versions():
+                self._all_resources.extend(self._group_version_resources(api_version).values())
+        return self._all_resources
+
+    def resolve(self, resource):
+        """Resolve a kubectl style resource argument (plural, singular, short name or kind,
+        optionally suffixed with .group) to a discovered resource."""
+        name, _, group = resource.lower().partition('.')
+        while True:
+            for res in self.discover():
+                res_group = res['api_version'].rpartition('/')[0]
+                if group and group != res_group and not res_group.startswith(group + '.'):
+                    continue
+                if name in (res['name'], res['singular'], res['kind'].lower()) or name in res['short_names']:
+                    return res
+            if not self._cached:
+                break
+            # The resource may be newer than the cached discovery, discover again
+            self._discovery, self._preferred, self._all_resources = {}, None, None
+            self._cached = False
+            self._cache_time = time.time()
+        self.module.fail_json(msg='the server doesn\'t have a resource type "%s"' % resource)
+
+    def path(self, resource, namespace=None, name=None):
+        path = self.group_version_path(resource['api_version'])
+        if resource['namespaced'] and namespace:
+            path += '/namespaces/' + quote(namespace, safe='')
+        path += '/' + resource['name']
+        if name:
+            path += '/' + quote(name, safe='')
+        return path
+
+
+def applyset_id(name, namespace, kind, group):
+    """Compute the ID of an ApplySet from its parent object, as kubectl does."""
+    digest = hashlib.sha256(('%s.%s.%s.%s' % (name, namespace, kind, group)).encode()).digest()
+    return 'applyset-%s-v1' % base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def applyset_contents(parent):
+    """Return the group kinds and additional namespaces recorded on an ApplySet parent."""
+    annotations = parent['metadata'].get('annotations') or {}
+    return tuple(set(v for v in (annotations.get(key) or '').split(',') if v)
+                 for key in (APPLYSET_GROUP_KINDS_ANNOTATION, APPLYSET_NAMESPACES_ANNOTATION))
+
+
+def group_kind(resource):
+    group = resource['api_version'].rpartition('/')[0]
+    return resource['kind'] + ('.' + group if group else '')
+
+
+def definition_text(definition):
+    """Return the manifest text of the definition parameter: YAML or JSON as given,
+    or a JSON List of the objects given as a dict or list of dicts."""
+    if not definition:
+        return None
+    if isinstance(definition, dict):
+        definition = [definition]
+    if isinstance(definition, list):
+        return json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': definition}, default=str)
+    return str(definition)
+
+
+def three_way_merge_patch(original, modified, current):
+    """Compute a JSON merge patch turning current into modified, also removing the fields
+    present in original (the last applied configuration) but no longer in modified.
+
+    Unlike the strategic merge patch of kubectl, lists are replaced as a whole."""
+    patch = {}
+    for key, value in modified.items():
+        if isinstance(value, dict) and isinstance(current.get(key), dict):
+            sub = three_way_merge_patch((original or {}).get(key) or {}, value, current[key])
+            if sub:
+                patch[key] = sub
+        elif current.get(key) != value:
+            patch[key] = value
+    for key in original or {}:
+        if key not in modified and key in current:
+            patch[key] = None
+    return patch
+
+
+def iter_documents(stream):
+    """Yield the documents of a YAML stream as text, without parsing them."""
+    lines = []
+    for line in stream:
+        if (line.startswith('---') and line[3:4] in ('', ' ', '\t', '\r', '\n')) or line.rstrip() == '...':
+            document = ''.join(lines)
+            if any(l.strip() and not l.lstrip().startswith('#') for l in lines):
+                yield document
+            lines = [line[3:].lstrip()] if line.startswith('---') else []
+        else:
+            lines.append(line)
+    if any(l.strip() and not l.lstrip().startswith('#') for l in lines):
+        yield ''.join(lines)
+
+
+class KubeWaitError(Exception):
+    pass
+
+
+def _condition(obj, condition_type):
+    for condition in (obj.get('status') or {}).get('conditions') or []:
+        if condition.get('type') == condition_type:
+            return condition.get('status') == 'True'
+    return False
+
+
+def object_ready(obj):
+    """Tell whether a workload, Job or CRD is ready, following kubectl rollout status."""
+    kind = obj['kind']
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+
+    if kind == 'CustomResourceDefinition':
+        return _condition(obj, 'Established')
+    if kind == 'Job':
+        if _condition(obj, 'Failed'):
+            raise KubeWaitError('job failed')
+        return _condition(obj, 'Complete')
+
+    if status.get('observedGeneration', 0) < obj['metadata'].get('generation', 0):
+        return False
+    if kind == 'Deployment':
+        replicas = spec.get('replicas', 1)
+        updated = status.get('updatedReplicas', 0)
+        return (updated >= replicas and status.get('replicas', 0) <= updated
+                and status.get('availableReplicas', 0) >= updated)
+    if kind == 'DaemonSet':
+        desired = status.get('desiredNumberScheduled', 0)
+        return (status.get('updatedNumberScheduled', 0) >= desired
+                and status.get('numberAvailable', 0) >= desired)
+    if kind == 'StatefulSet':
+        replicas = spec.get('replicas', 1)
+        if status.get('readyReplicas', 0) < replicas:
+            return False
+        partition = ((spec.get('updateStrategy') or {}).get('rollingUpdate') or {}).get('partition')
+        if partition:
+            return status.get('updatedReplicas', 0) >= replicas - partition
+        return status.get('updateRevision') == status.get('currentRevision')
+    return True
+
+
+def object_scaled(obj, replicas):
+    """Tell whether a workload runs the given number of ready replicas."""
+    status = obj.get('status') or {}
+    if status.get('observedGeneration', 0) < obj['metadata'].get('generation', 0):
+        return False
+    return status.get('replicas', 0) == replicas and status.get('readyReplicas', 0) == replicas
+
+
 class KubeManager(object):
 
     def __init__(self, module):
 
         self.module = module
+        self.timings = []
+
+        self._init_engine()
+        self._load_params(module.params)
+
+    def _load_params(self, params):
+        self.all = params.get('all')
+        self.force = params.get('force')
+        self.wait = params.get('wait')
+        self.name = params.get('name')
+        self.namespace = params.get('namespace')
+        self.filename = [f.strip() for f in params.get('filename') or []]
+        self.definition = definition_text(params.get('definition'))
+        self.resource = params.get('resource')
+        self.label = params.get('label')
+        self.recursive = params.get('recursive')
+        self.fingerprint = params.get('fingerprint')
+        self.fingerprint_file = params.get('fingerprint_file')
+        self.manifest_digest = None
+        self.wait_for = params.get('wait_for')
+        self.wait_timeout = params.get('wait_timeout')
+        self.parallel = params.get('parallel')
+        self.phased = params.get('phased')
+        self.chunk_size = params.get('chunk_size')
+        self.checkpoint_file = params.get('checkpoint_file')
+        self.replicas = params.get('replicas')
+        self.bulk = params.get('bulk')
+        self.server_side = params.get('server_side')
+        self.field_manager = params.get('field_manager')
+        self.force_conflicts = params.get('force_conflicts')
+        self.prune = params.get('prune')
+        self.applyset = params.get('applyset')
+        if self.parallel < 1:
+            self.module.fail_json(msg='parallel must be at least 1')
+        if self.phased and self.chunk_size:
+            self.module.fail_json(msg='phased and chunk_size are mutually exclusive')
+        if self.definition and self.chunk_size:
+            self.module.fail_json(msg='chunk_size cannot be used with definition')
+        if self.prune and not self.applyset:
+            self.module.fail_json(msg='applyset required to prune')
+        if self.prune and (self.phased or self.chunk_size):
+            self.module.fail_json(msg='prune cannot be used with phased or chunk_size')
+        self.readiness = []
+
+    def for_item(self, item):
+        """Return a copy of this manager handling one entry of the items parameter.
+
+        The resource selection comes from the item only, other options default
+        to the module parameters."""
+        manager = copy.copy(self)
+        params = dict(self.module.params, filename=None, definition=None, resource=None, name=None,
+                      label=None)
+        params.update((k, v) for k, v in item.items() if v is not None)
+        manager._load_params(params)
+        return manager
+
+    def _init_engine(self):
+        module = self.module
 
         self.kubectl = module.params.get('kubectl')
         if self.kubectl is None:
@@ -137,23 +969,25 @@ class KubeManager(object):
         if module.params.get('log_level'):
             self.base_cmd.append('--v=' + str(module.params.get('log_level')))
 
-        if module.params.get('namespace'):
-            self.base_cmd.append('--namespace=' + module.params.get('namespace'))
+        if module.params.get('cache_dir'):
+            self.base_cmd.append('--cache-dir=' + module.params.get('cache_dir'))
+            # Only when asked for, kubectl keeps its cache longer on its own
+            if module.params.get('cache_ttl') is not None:
+                expire_kubectl_cache(module.params.get('cache_dir'), module.params.get('cache_ttl'))
 
+    def close(self):
+        pass
 
-        self.all = module.params.get('all')
-        self.force = module.params.get('force')
-        self.wait = module.params.get('wait')
-        self.name = module.params.get('name')
-        self.filename = [f.strip() for f in module.params.get('filename') or []]
-        self.resource = module.params.get('resource')
-        self.label = module.params.get('label')
-        self.recursive = module.params.get('recursive')
+    def _command(self, cmd, namespace=None):
+        namespace = namespace or self.namespace
+        if namespace:
+            return self.base_cmd + ['--namespace=' + namespace] + cmd
+        return self.base_cmd + cmd
 
-    def _execute(self, cmd):
-        args = self.base_cmd + cmd
+    def _execute(self, cmd, data=None):
+        args = self._command(cmd)
         try:
-            rc, out, err = self.module.run_command(args)
+            rc, out, err = self._run(args, data=data)
             if rc != 0:
                 self.module.fail_json(
                     msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
@@ -162,54 +996,353 @@ class KubeManager(object):
                 msg='error running kubectl (%s) command: %s' % (' '.join(args), str(exc)))
         return out.splitlines()
 
-    def _execute_nofail(self, cmd):
-        args = self.base_cmd + cmd
-        rc, out, err = self.module.run_command(args)
+    def _execute_nofail(self, cmd, data=None):
+        args = self._command(cmd)
+        rc, out, err = self._run(args, data=data)
         if rc != 0:
             return None
         return out.splitlines()
 
-    def create(self, check=True, force=True):
-        if check and self.exists():
+    def _run(self, args, data=None):
+        start = time.time()
+        # ApplySets are still gated behind an environment variable in kubectl
+        environ = {'KUBECTL_APPLYSET': 'true'} if self.prune else {}
+        rc, out, err = self.module.run_command(args, data=data, environ_update=environ)
+        self.timings.append(dict(command=' '.join(args), rc=rc, start=start,
+                                 seconds=round(time.time() - start, 4),
+                                 stdin_bytes=len((data or '').encode()),
+                                 stdout_bytes=len(out.encode()), stderr_bytes=len(err.encode())))
+        return rc, out, err
+
+    def _filename_arg(self):
+        # kubectl reads an inline definition from stdin
+        if self.definition:
+            return '--filename=-'
+        return '--filename=' + ','.join(self.filename)
+
+    def _manifest_files(self):
+        files = []
+        for filename in self.filename:
+            if not os.path.isdir(filename):
+                files.append(filename)
+                continue
+            for root, dirs, names in os.walk(filename):
+                files.extend(os.path.join(root, n) for n in sorted(names)
+                             if n.endswith(MANIFEST_EXTENSIONS))
+                if not self.recursive:
+                    break
+                dirs.sort()
+        return files
+
+    def _objects(self):
+        if not HAS_YAML:
+            self.module.fail_json(msg=missing_required_lib('PyYAML'))
+
+        sources = [(filename, lambda f=filename: open(f)) for filename in self._manifest_files()]
+        if self.definition:
+            sources = [('definition', lambda: io.StringIO(self.definition))]
+
+        objects = []
+        for filename, source in sources:
+            try:
+                with source() as manifest:
+                    documents = list(yaml.safe_load_all(manifest))
+            except (IOError, yaml.YAMLError) as exc:
+                self.module.fail_json(msg='error reading %s: %s' % (filename, exc))
+            for document in documents:
+                if not document:
+                    continue
+                if document.get('kind', '').endswith('List') and 'items' in document:
+                    objects.extend(document['items'])
+                else:
+                    objects.append(document)
+        return objects
+
+    def _apply_phased(self, force):
+        """Apply Namespaces and CRDs first, wait for the CRDs to be established,
+        then apply all the other objects concurrently."""
+        objects = self._objects()
+        first = [obj for obj in objects if obj.get('kind') in FIRST_KINDS]
+        rest = [obj for obj in objects if obj.get('kind') not in FIRST_KINDS]
+
+        result = self._apply_objects(first, force, 1)
+        self._wait_objects([obj for obj in first if obj['kind'] == 'CustomResourceDefinition'])
+        return result + self._apply_objects(rest, force, self.parallel)
+
+    def _apply_objects(self, objects, force, workers):
+        """Apply objects through kubectl apply --filename=-, splitting them between workers."""
+        if not objects:
             return []
+        args = self._command(self._stdin_apply_cmd(force))
 
+        size = -(-len(objects) // workers)
+        chunks = [objects[i:i + size] for i in range(0, len(objects), size)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            runs = list(pool.map(
+                lambda chunk: self._run(args, data='\n---\n'.join(json.dumps(obj, default=str) for obj in chunk)),
+                chunks))
+
+        errors = ['(rc=%d) out=\'%s\', err=\'%s\'' % (rc, out, err) for rc, out, err in runs if rc != 0]
+        if errors:
+            self.module.fail_json(
+                msg='error running kubectl (%s) command: %s' % (' '.join(args), ', '.join(errors)))
+        return [line for rc, out, err in runs for line in out.splitlines()]
+
+    def _apply_context(self):
+        """The namespace, cluster and apply options manifests are hashed together with,
+        so that changing any of them applies the manifests again."""
+        params = self.module.params
+        return json.dumps([self.namespace or '', params.get('server'), params.get('kubeconfig'),
+                           self.server_side, self.field_manager if self.server_side else None,
+                           self.prune, self.applyset, self.force]).encode() + b'\0'
+
+    def _state_key(self, key):
+        """Key of a state file entry, including the context, so that tasks applying the
+        same manifests to other namespaces or clusters keep their own entries."""
+        return '%s@%s' % (key, hashlib.sha256(self._apply_context()).hexdigest()[:16])
+
+    def _file_digest(self, filename):
+        """Hash a manifest file, together with the context it is applied in."""
+        sha = hashlib.sha256(self._apply_context())
+        try:
+            with open(filename, 'rb') as manifest:
+                for chunk in iter(lambda: manifest.read(65536), b''):
+                    sha.update(chunk)
+        except IOError as exc:
+            self.module.fail_json(msg='error reading %s: %s' % (filename, exc))
+        return sha.hexdigest()
+
+    def _fingerprints(self):
+        if self.definition:
+            # Keyed by the objects defined, so that the entry is kept as their content changes
+            key = 'definition:' + ','.join(sorted(
+                '%s/%s/%s' % (obj.get('kind'), (obj.get('metadata') or {}).get('namespace') or self.namespace or '',
+                              (obj.get('metadata') or {}).get('name')) for obj in self._objects()))
+            sha = hashlib.sha256(self._apply_context() + self.definition.encode())
+            return {key: sha.hexdigest()}
+        return dict((os.path.abspath(f), self._file_digest(f)) for f in self._manifest_files())
+
+    @staticmethod
+    def _read_state(path):
+        try:
+            with open(path) as state:
+                return json.load(state)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_state(self, path, updates):
+        """Update the entries of a JSON state file, removing those set to None."""
+        state = self._read_state(path)
+        state.update(updates)
+        state = dict((k, v) for k, v in state.items() if v is not None)
+        directory = os.path.dirname(path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(state, tmp_file, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+    def _apply_chunked(self, force):
+        """Stream the documents of each manifest, applying chunk_size of them at a time.
+
+        Progress is recorded in checkpoint_file after each chunk, so that when a
+        previous attempt failed on an unchanged manifest, the apply resumes at the
+        first chunk not applied yet."""
+        result = []
+        for filename in self._manifest_files():
+            key = self._state_key(os.path.abspath(filename))
+            progress = dict(sha256=self._file_digest(filename), chunk_size=self.chunk_size, chunks=0)
+            previous = self._read_state(self.checkpoint_file).get(key) or {}
+            if all(previous.get(k) == progress[k] for k in ('sha256', 'chunk_size')):
+                progress['chunks'] = previous.get('chunks', 0)
+
+            with open(filename) as manifest:
+                documents = iter_documents(manifest)
+                # Skip over the chunks already applied
+                for _ in range(progress['chunks'] * self.chunk_size):
+                    next(documents, None)
+                while True:
+                    chunk = list(itertools.islice(documents, self.chunk_size))
+                    if not chunk:
+                        break
+                    result.extend(self._apply_documents(chunk, force))
+                    progress['chunks'] += 1
+                    self._write_state(self.checkpoint_file, {key: progress})
+            self._write_state(self.checkpoint_file, {key: None})
+        return result
+
+    def _apply_documents(self, documents, force):
+        return self._execute(self._stdin_apply_cmd(force), data='\n---\n'.join(documents))
+
+    def _stdin_apply_cmd(self, force):
+        return self._apply_cmd(force) + ['--filename=-']
+
+    def _apply_cmd(self, force):
         cmd = ['apply']
 
-        if force:
+        if self.server_side:
+            cmd.extend(['--server-side', '--field-manager=' + self.field_manager])
+            if self.force_conflicts:
+                cmd.append('--force-conflicts')
+        elif force:
+            # kubectl refuses --force together with --server-side
             cmd.append('--force')
 
         if self.wait:
             cmd.append('--wait')
 
+        if self.prune:
+            cmd.extend(['--prune', '--applyset=' + self.applyset])
+
+        return cmd
+
+    def _apply_manifests(self, apply):
+        """Run apply, unless the fingerprint of the manifests shows they were already applied,
+        then wait for the applied objects as requested by wait_for."""
+        if self.fingerprint == 'none':
+            return self._wait_ready(apply())
+
+        digests = self._fingerprints()
+        self.manifest_digest = hashlib.sha256(''.join(
+            '%s=%s\n' % item for item in sorted(digests.items())).encode()).hexdigest()
+
+        if self.fingerprint == 'file':
+            keyed = dict((self._state_key(f), d) for f, d in digests.items())
+            state = self._read_state(self.fingerprint_file)
+            unchanged = all(state.get(k) == d for k, d in keyed.items())
+        else:
+            unchanged = self._annotated(self.manifest_digest)
+        if digests and unchanged:
+            # A previous run may have applied the manifests, then timed out waiting
+            return self._wait_ready(['%s unchanged' % f for f in sorted(digests)])
+
+        result = self._wait_ready(apply())
+        # Only recorded once the objects are ready, wait_for failing the task before
+        if self.fingerprint == 'file':
+            self._write_state(self.fingerprint_file, keyed)
+        else:
+            self._annotate(self.manifest_digest)
+        return result
+
+    def _wait_ready(self, result):
+        """Wait concurrently until every workload and CRD in the manifests is ready."""
+        if self.wait_for != 'ready':
+            return result
+
+        self._wait_objects([obj for obj in self._applied_objects() if obj['kind'] in READY_KINDS])
+        return result
+
+    def _wait_objects(self, objects):
+        deadline = time.time() + self.wait_timeout
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            readiness = list(pool.map(lambda obj: self._wait_object_ready(obj, deadline), objects))
+        self.readiness.extend(readiness)
+
+        not_ready = [r for r in readiness if not r['ready']]
+        if not_ready:
+            self.module.fail_json(
+                msg='%d object(s) not ready after %ds: %s' % (
+                    len(not_ready), self.wait_timeout,
+                    ', '.join('%s/%s: %s' % (r['kind'], r['name'], r['error']) for r in not_ready)),
+                readiness=self.readiness)
+
+    def _applied_objects(self):
+        cmd = ['get', self._filename_arg(), '--output=json']
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+        listing = json.loads('\n'.join(self._execute(cmd, data=self.definition)))
+        return listing['items'] if listing.get('kind') == 'List' else [listing]
+
+    def _wait_object_ready(self, obj, deadline):
+        start = time.time()
+        metadata = obj['metadata']
+        readiness = dict(kind=obj['kind'], namespace=metadata.get('namespace'), name=metadata['name'],
+                         ready=True, error=None)
+        try:
+            ready = object_ready(obj)
+        except KubeWaitError as exc:
+            return dict(readiness, ready=False, error=str(exc), seconds=0)
+
+        if not ready:
+            ref = '%s/%s' % (obj['kind'].lower(), metadata['name'])
+            timeout = '--timeout=%ds' % max(1, deadline - start)
+            if obj['kind'] == 'Job':
+                cmd = ['wait', '--for=condition=Complete', ref, timeout]
+            elif obj['kind'] == 'CustomResourceDefinition':
+                cmd = ['wait', '--for=condition=Established', ref, timeout]
+            else:
+                cmd = ['rollout', 'status', ref, timeout]
+            # kubectl rollout status and kubectl wait both watch the object
+            rc, out, err = self._run(self._command(cmd, metadata.get('namespace')))
+            if rc != 0:
+                readiness.update(ready=False, error=err.strip() or out.strip())
+        readiness['seconds'] = round(time.time() - start, 3)
+        return readiness
+
+    def _annotated(self, digest):
+        cmd = ['get', self._filename_arg(), '--output=json']
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
+        out = self._execute_nofail(cmd, data=self.definition)
+        if not out:
+            return False
+        try:
+            listing = json.loads('\n'.join(out))
+        except ValueError:
+            return False
+        objects = listing['items'] if listing.get('kind') == 'List' else [listing]
+        return all((obj['metadata'].get('annotations') or {}).get(FINGERPRINT_ANNOTATION) == digest
+                   for obj in objects)
+
+    def _annotate(self, digest):
+        cmd = ['annotate', '--overwrite', self._filename_arg()]
         if self.recursive:
             cmd.append('--recursive={}'.format(self.recursive))
+        cmd.append('%s=%s' % (FINGERPRINT_ANNOTATION, digest))
+        self._execute(cmd, data=self.definition)
 
-        if not self.filename:
-            self.module.fail_json(msg='filename required to create')
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
+
+        cmd = self._apply_cmd(force)
 
-        cmd.append('--filename=' + ','.join(self.filename))
+        if self.recursive:
+            cmd.append('--recursive={}'.format(self.recursive))
 
-        return self._execute(cmd)
+        if not (self.filename or self.definition):
+            self.module.fail_json(msg='filename or definition required to create')
 
-    def replace(self, force=True):
+        if self.phased:
+            return self._apply_manifests(lambda: self._apply_phased(force))
 
-        cmd = ['apply']
+        if self.chunk_size:
+            return self._apply_manifests(lambda: self._apply_chunked(force))
 
-        if force:
-            cmd.append('--force')
+        cmd.append(self._filename_arg())
 
-        if self.wait:
-            cmd.append('--wait')
+        return self._apply_manifests(lambda: self._execute(cmd, data=self.definition))
+
+    def replace(self, force=True):
+
+        cmd = self._apply_cmd(force)
 
         if self.recursive:
             cmd.append('--recursive={}'.format(self.recursive))
 
-        if not self.filename:
-            self.module.fail_json(msg='filename required to reload')
+        if not (self.filename or self.definition):
+            self.module.fail_json(msg='filename or definition required to reload')
+
+        if self.phased:
+            return self._apply_manifests(lambda: self._apply_phased(force))
+
+        if self.chunk_size:
+            return self._apply_manifests(lambda: self._apply_chunked(force))
 
-        cmd.append('--filename=' + ','.join(self.filename))
+        cmd.append(self._filename_arg())
 
-        return self._execute(cmd)
+        return self._apply_manifests(lambda: self._execute(cmd, data=self.definition))
 
     def delete(self):
 
@@ -218,8 +1351,8 @@ class KubeManager(object):
 
         cmd = ['delete']
 
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
+        if self.filename or self.definition:
+            cmd.append(self._filename_arg())
             if self.recursive:
                 cmd.append('--recursive={}'.format(self.recursive))
         else:
@@ -243,13 +1376,32 @@ class KubeManager(object):
             if self.recursive:
                 cmd.append('--recursive={}'.format(self.recursive))
 
-        return self._execute(cmd)
+        if self.bulk:
+            return self._bulk_delete(cmd)
+        return self._execute(cmd, data=self.definition)
+
+    def _bulk_delete(self, cmd):
+        """Delete in the background without waiting on every object in turn, then with
+        wait, wait for all of them at once with a single kubectl wait."""
+        result = self._execute(cmd + ['--cascade=background', '--wait=false'], data=self.definition)
+        if not self.wait:
+            return result
+
+        wait = ['wait', '--for=delete', '--timeout=%ds' % self.wait_timeout]
+        wait.extend(arg for arg in cmd[1:] if arg != '--ignore-not-found')
+        args = self._command(wait)
+        rc, out, err = self._run(args, data=self.definition)
+        # kubectl wait fails when a selector matches nothing, that is once everything is gone
+        if rc != 0 and 'no matching resources found' not in err:
+            self.module.fail_json(
+                msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
+        return result
 
     def exists(self):
         cmd = ['get']
 
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
+        if self.filename or self.definition:
+            cmd.append(self._filename_arg())
             if self.recursive:
                 cmd.append('--recursive={}'.format(self.recursive))
         else:
@@ -267,52 +1419,651 @@ class KubeManager(object):
             if self.all:
                 cmd.append('--all-namespaces')
 
-        cmd.append('--no-headers')
+        # Names only: no table rendering, neither by the API server nor by kubectl
+        cmd.append('--output=name')
 
-        result = self._execute_nofail(cmd)
+        result = self._execute_nofail(cmd, data=self.definition)
         if not result:
             return False
         return True
 
-    # TODO: This is currently unused, perhaps convert to 'scale' with a replicas param?
-    def stop(self):
+    def discover(self):
+        """Fill the discovery cache, for the next kubectl commands to use."""
+        resources = self._execute(['api-resources', '--output=name'])
+        return ['%d resources discovered' % len(resources)]
+
+    def scale(self):
+        """Scale every workload selected concurrently, then with wait, wait until
+        all of them run the number of ready replicas asked for."""
+        if self.replicas is None:
+            self.module.fail_json(msg='replicas required to scale')
+
+        if self.filename or self.definition:
+            workloads = self._applied_objects()
+        else:
+            if not self.resource:
+                self.module.fail_json(msg='resource required to scale without filename')
+            if not (self.name or self.label or self.all):
+                self.module.fail_json(msg='name, label or all required to scale without filename')
+            cmd = ['get', self.resource]
+            if self.name:
+                cmd.append(self.name)
+            if self.label:
+                cmd.append('--selector=' + self.label)
+            if self.all:
+                cmd.append('--all-namespaces')
+            listing = json.loads('\n'.join(self._execute(cmd + ['--output=json'])))
+            workloads = listing['items'] if listing.get('kind') == 'List' else [listing]
+
+        result = []
+        selected = {}
+        to_scale = {}
+        for obj in workloads:
+            if obj['kind'] not in SCALE_KINDS:
+                continue
+            ref = '%s/%s' % (obj['kind'].lower(), obj['metadata']['name'])
+            namespace = obj['metadata'].get('namespace')
+            selected.setdefault(namespace, []).append(ref)
+            if (obj.get('spec') or {}).get('replicas', 1) == self.replicas:
+                result.append(ref + ' unchanged')
+            else:
+                to_scale.setdefault(namespace, []).append(ref)
+
+        # One kubectl scale per namespace, all of them at once
+        for out in self._run_concurrently([(namespace, ['scale', '--replicas=%d' % self.replicas] + refs)
+                                           for namespace, refs in sorted(to_scale.items())]):
+            result.extend(out.splitlines())
+
+        if self.wait:
+            self._wait_scaled(sorted(selected.items()))
+        return result
+
+    def _run_concurrently(self, commands):
+        """Run (namespace, cmd) kubectl commands concurrently and return their outputs."""
+        commands = [self._command(cmd, namespace) for namespace, cmd in commands]
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            runs = list(pool.map(self._run, commands))
+        for args, (rc, out, err) in zip(commands, runs):
+            if rc != 0:
+                self.module.fail_json(
+                    msg='error running kubectl (%s) command (rc=%d), out=\'%s\', err=\'%s\'' % (' '.join(args), rc, out, err))
+        return [out for rc, out, err in runs]
+
+    def _wait_scaled(self, selected):
+        """Poll the workloads of each namespace at once until all of them are scaled."""
+        deadline = time.time() + self.wait_timeout
+        while True:
+            pending = []
+            for out in self._run_concurrently([(namespace, ['get', '--output=json'] + refs)
+                                               for namespace, refs in selected]):
+                listing = json.loads(out)
+                for obj in listing['items'] if listing.get('kind') == 'List' else [listing]:
+                    if not object_scaled(obj, self.replicas):
+                        pending.append('%s/%s' % (obj['kind'].lower(), obj['metadata']['name']))
+            if not pending:
+                return
+            if time.time() >= deadline:
+                self.module.fail_json(msg='%d object(s) not scaled to %d replicas after %ds: %s' % (
+                    len(pending), self.replicas, self.wait_timeout, ', '.join(pending)))
+            time.sleep(1)
+
+    def run(self, state):
+        if state == 'present':
+            return self.create(check=False)
+
+        elif state == 'absent':
+            return self.delete()
+
+        elif state == 'reloaded':
+            return self.replace()
+
+        elif state == 'scaled':
+            return self.scale()
+
+        elif state == 'latest':
+            return self.replace()
+
+        elif state == 'exists':
+            return self.exists()
+
+        elif state == 'discovered':
+            return self.discover()
+
+        self.module.fail_json(msg='Unrecognized state %s.' % state)
+
+
+class KubeApiManager(KubeManager):
+    """KubeManager talking to the API server directly instead of running kubectl."""
+
+    def _init_engine(self):
+        if not HAS_YAML:
+            self.module.fail_json(msg=missing_required_lib('PyYAML'))
+
+        cache_ttl = self.module.params.get('cache_ttl')
+        self.client = KubeApiClient(self.module,
+                                    kubeconfig=self.module.params.get('kubeconfig'),
+                                    server=self.module.params.get('server'),
+                                    pool_size=self.module.params.get('parallel'),
+                                    timings=self.timings,
+                                    cache_dir=self.module.params.get('cache_dir'),
+                                    cache_ttl=DEFAULT_CACHE_TTL if cache_ttl is None else cache_ttl)
+
+    def _load_params(self, params):
+        super(KubeApiManager, self)._load_params(params)
+        if not self.namespace:
+            self.namespace = self.client.namespace
+
+    def close(self):
+        self.client.close()
+
+    def _fail(self, exc):
+        self.module.fail_json(msg='error calling the Kubernetes API: %s' % exc)
+
+    def _locate(self, obj):
+        """Return the resource, namespace and name of a manifest object."""
+        resource = self.client.resource_for(obj['apiVersion'], obj['kind'])
+        metadata = obj.setdefault('metadata', {})
+        namespace = None
+        if resource['namespaced']:
+            namespace = metadata.setdefault('namespace', self.namespace)
+        return resource, namespace, metadata['name']
+
+    @staticmethod
+    def _display(resource):
+        group = resource['api_version'].rpartition('/')[0]
+        return resource['singular'] + ('.' + group if group else '')
+
+    def _apply(self, force):
+        if not (self.filename or self.definition):
+            self.module.fail_json(msg='filename or definition required to apply')
+        try:
+            if self.prune:
+                return self._apply_manifests(lambda: self._apply_applyset(force))
+            if self.phased:
+                return self._apply_manifests(lambda: self._apply_phased(force))
+            if self.chunk_size:
+                return self._apply_manifests(lambda: self._apply_chunked(force))
+            return self._apply_manifests(lambda: self._apply_objects(self._objects(), force, 1))
+        except KubeApiError as exc:
+            self._fail(exc)
+
+    def _apply_documents(self, documents, force):
+        objects = []
+        for document in documents:
+            try:
+                obj = yaml.safe_load(document)
+            except yaml.YAMLError as exc:
+                self.module.fail_json(msg='error parsing manifest document: %s' % exc)
+            if obj and obj.get('kind', '').endswith('List') and 'items' in obj:
+                objects.extend(obj['items'])
+            elif obj:
+                objects.append(obj)
+        return self._apply_objects(objects, force, 1)
+
+    def _apply_objects(self, objects, force, workers):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda obj: self._apply_object(obj, force), objects))
+
+    def _annotated(self, digest):
+        try:
+            for obj in self._objects():
+                current = self.client.request('GET', self.client.path(*self._locate(obj)))
+                if (current['metadata'].get('annotations') or {}).get(FINGERPRINT_ANNOTATION) != digest:
+                    return False
+        except KubeApiError:
+            return False
+        return True
+
+    def _annotate(self, digest):
+        # The annotation is added to the objects when they are applied
+        pass
+
+    def _apply_applyset(self, force):
+        """Apply the objects as members of an ApplySet, then prune the members
+        no longer in the manifests, following the kubectl ApplySet specification."""
+        kind, _, name = self.applyset.rpartition('/')
+        parent_resource = self.client.resolve(kind or 'secret')
+        if parent_resource['kind'] not in ('Secret', 'ConfigMap'):
+            self.module.fail_json(msg='the applyset parent must be a Secret or a ConfigMap')
+        parent_path = self.client.path(parent_resource, self.namespace, name)
+        self.applyset_id = applyset_id(name, self.namespace, parent_resource['kind'], '')
+
+        try:
+            parent = self.client.request('GET', parent_path)
+        except KubeApiError as exc:
+            if exc.status != 404:
+                raise
+            parent = self.client.request('POST', self.client.path(parent_resource, self.namespace), body={
+                'apiVersion': 'v1', 'kind': parent_resource['kind'],
+                'metadata': {'name': name, 'namespace': self.namespace,
+                             'labels': {APPLYSET_ID_LABEL: self.applyset_id},
+                             'annotations': {APPLYSET_TOOLING_ANNOTATION: APPLYSET_TOOLING}}})
+        if (parent['metadata'].get('labels') or {}).get(APPLYSET_ID_LABEL) != self.applyset_id:
+            self.module.fail_json(msg='%s is not the parent of an applyset' % self.applyset)
+
+        objects = self._objects()
+        targets = [self._locate(obj) for obj in objects]
+        group_kinds = set(group_kind(resource) for resource, namespace, name in targets)
+        namespaces = set(namespace for resource, namespace, name in targets if namespace) - set([self.namespace])
+        previous_group_kinds, previous_namespaces = applyset_contents(parent)
+
+        # Record the union first, so that an interrupted run still prunes on the next one
+        self._update_applyset(parent_path, group_kinds | previous_group_kinds, namespaces | previous_namespaces)
+        result = self._apply_objects(objects, force, 1)
+
+        applied = set((group_kind(resource), namespace, name) for resource, namespace, name in targets)
+        selector = {'labelSelector': '%s=%s' % (APPLYSET_PART_OF_LABEL, self.applyset_id)}
+        for gk in sorted(group_kinds | previous_group_kinds):
+            resource = self.client.resolve(gk)
+            scopes = [None]
+            if resource['namespaced']:
+                scopes = [self.namespace] + sorted(namespaces | previous_namespaces)
+            for namespace in scopes:
+                listing = self.client.request('GET', self.client.path(resource, namespace),
+                                              query=selector, accept=METADATA_LIST_ACCEPT)
+                for item in listing.get('items', []):
+                    member = item['metadata']['name']
+                    if (gk, namespace, member) in applied:
+                        continue
+                    self.client.request('DELETE', self.client.path(resource, namespace, member),
+                                        body={'propagationPolicy': 'Background'})
+                    result.append('%s/%s pruned' % (self._display(resource), member))
+
+        self._update_applyset(parent_path, group_kinds, namespaces)
+        return result
+
+    def _update_applyset(self, parent_path, group_kinds, namespaces):
+        self.client.request('PATCH', parent_path, content_type='application/merge-patch+json', body={
+            'metadata': {'annotations': {
+                APPLYSET_GROUP_KINDS_ANNOTATION: ','.join(sorted(group_kinds)),
+                APPLYSET_NAMESPACES_ANNOTATION: ','.join(sorted(namespaces)) or None,
+            }}})
+
+    def _apply_object(self, obj, force):
+        """Client side apply with a JSON merge patch, recording the last-applied-configuration
+        kubectl reads, or server side apply with server_side."""
+        resource, namespace, name = self._locate(obj)
+        display = '%s/%s' % (self._display(resource), name)
+        path = self.client.path(resource, namespace, name)
+        annotations = obj['metadata'].setdefault('annotations', {})
+        if self.fingerprint == 'annotation':
+            annotations[FINGERPRINT_ANNOTATION] = self.manifest_digest
+        if self.prune:
+            obj['metadata'].setdefault('labels', {})[APPLYSET_PART_OF_LABEL] = self.applyset_id
+        if self.server_side:
+            return self._server_side_apply(obj, display, path)
+
+        annotations.pop(LAST_APPLIED_ANNOTATION, None)
+        annotations[LAST_APPLIED_ANNOTATION] = json.dumps(obj, default=str, sort_keys=True)
+
+        try:
+            current = self.client.request('GET', path)
+        except KubeApiError as exc:
+            if exc.status != 404:
+                raise
+            self.client.request('POST', self.client.path(resource, namespace), body=obj)
+            return display + ' created'
+
+        original = (current['metadata'].get('annotations') or {}).get(LAST_APPLIED_ANNOTATION)
+        patch = three_way_merge_patch(json.loads(original) if original else None,
+                                      json.loads(json.dumps(obj, default=str)), current)
+        if not patch:
+            return display + ' unchanged'
+        try:
+            patched = self.client.request('PATCH', path, body=patch,
+                                          content_type='application/merge-patch+json')
+        except KubeApiError as exc:
+            if not force or exc.status not in (409, 422):
+                raise
+            # Same as kubectl apply --force: delete and re-create when the patch is refused
+            self.client.request('DELETE', path, body={'propagationPolicy': 'Background'})
+            self._wait_deleted(path, current['metadata']['uid'])
+            self.client.request('POST', self.client.path(resource, namespace), body=obj)
+            return display + ' replaced'
+        # Fields defaulted by the server make the patch non-empty even when nothing changes
+        if patched['metadata']['resourceVersion'] == current['metadata']['resourceVersion']:
+            return display + ' unchanged'
+        return display + ' configured'
+
+    def _applied_objects(self):
+        return self._objects()
+
+    def _wait_object_ready(self, obj, deadline):
+        start = time.time()
+        resource, namespace, name = self._locate(obj)
+        readiness = dict(kind=obj['kind'], namespace=namespace, name=name, ready=True, error=None)
+        try:
+            current = self.client.request('GET', self.client.path(resource, namespace, name))
+            while not object_ready(current):
+                if time.time() >= deadline:
+                    raise KubeWaitError('timed out')
+                current = self._watch_until_ready(resource, current, deadline)
+        except (KubeApiError, KubeWaitError) as exc:
+            readiness.update(ready=False, error=str(exc))
+        readiness['seconds'] = round(time.time() - start, 3)
+        return readiness
+
+    def _watch_until_ready(self, resource, current, deadline, ready=object_ready):
+        """Watch an object from its current version and return its last known state,
+        once it is ready or when the watch ends."""
+        metadata = current['metadata']
+        events = self.client.watch(self.client.path(resource, metadata.get('namespace')),
+                                   {'fieldSelector': 'metadata.name=' + metadata['name'],
+                                    'resourceVersion': metadata['resourceVersion']},
+                                   deadline - time.time())
+        try:
+            for event in events:
+                if event['type'] == 'ERROR':
+                    # Most likely an expired resource version, start again from a fresh read
+                    return self.client.request(
+                        'GET', self.client.path(resource, metadata.get('namespace'), metadata['name']))
+                if event['type'] != 'DELETED':
+                    current = event['object']
+                    if ready(current):
+                        break
+        finally:
+            events.close()
+        return current
+
+    def _server_side_apply(self, obj, display, path):
+        try:
+            before = self.client.request('GET', path, accept=METADATA_ACCEPT)['metadata']['resourceVersion']
+        except KubeApiError as exc:
+            if exc.status != 404:
+                raise
+            before = None
+        query = {'fieldManager': self.field_manager}
+        if self.force_conflicts:
+            query['force'] = 'true'
+        applied = self.client.request('PATCH', path, body=obj, query=query,
+                                      content_type='application/apply-patch+yaml')
+        if applied['metadata']['resourceVersion'] == before:
+            return display + ' unchanged'
+        return display + ' serverside-applied'
+
+    def _bulk_delete(self, targets):
+        """Issue every delete at once with background propagation, then with wait,
+        watch each kind and namespace until all the deleted objects are gone."""
+        def delete(target):
+            resource, namespace, name = target
+            try:
+                current = self.client.request('DELETE', self.client.path(resource, namespace, name),
+                                              body={'propagationPolicy': 'Background'})
+            except KubeApiError as exc:
+                if exc.status == 404 and self.force and not (self.filename or self.definition):
+                    return None
+                return exc
+            return (current.get('metadata') or {}).get('uid')
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            uids = list(pool.map(delete, targets))
+        errors = [exc for exc in uids if isinstance(exc, KubeApiError)]
+        if errors:
+            raise errors[0]
+
+        groups = {}
+        result = []
+        for (resource, namespace, name), uid in zip(targets, uids):
+            if uid is None:
+                continue
+            key = (resource['api_version'], resource['kind'], namespace)
+            groups.setdefault(key, (resource, namespace, set()))[2].add(uid)
+            result.append('%s "%s" deleted' % (self._display(resource), name))
+        if not self.wait:
+            return result
+
+        deadline = time.time() + self.wait_timeout
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            remaining = list(pool.map(lambda group: self._wait_group_deleted(deadline, *group),
+                                      groups.values()))
+        left = sum(remaining, [])
+        if left:
+            self.module.fail_json(msg='%d object(s) not deleted after %ds: %s' % (
+                len(left), self.wait_timeout, ', '.join(left)))
+        return result
+
+    def _wait_group_deleted(self, deadline, resource, namespace, uids):
+        """Watch the collection of a kind in a namespace until none of the objects with
+        the given uids remain, returning the names of those still there at the deadline."""
+        path = self.client.path(resource, namespace)
+        names = {}
+        while True:
+            listing = self.client.request('GET', path, accept=METADATA_LIST_ACCEPT)
+            names = dict((item['metadata']['uid'], item['metadata']['name'])
+                         for item in listing.get('items', []) if item['metadata']['uid'] in uids)
+            if not names or time.time() >= deadline:
+                return sorted('%s/%s' % (self._display(resource), n) for n in names.values())
+            query = {'resourceVersion': listing['metadata']['resourceVersion']}
+            try:
+                for event in self.client.watch(path, query, deadline - time.time()):
+                    if event['type'] == 'ERROR':
+                        break
+                    if event['type'] == 'DELETED':
+                        names.pop(event['object']['metadata'].get('uid'), None)
+                        if not names:
+                            return []
+            except KubeApiError as exc:
+                # The watch timed out or its connection dropped, list again
+                if exc.status is not None:
+                    raise
+
+    def _wait_deleted(self, path, uid):
+        while True:
+            try:
+                current = self.client.request('GET', path)
+            except KubeApiError as exc:
+                if exc.status == 404:
+                    return
+                raise
+            if uid and current['metadata'].get('uid') != uid:
+                return
+            time.sleep(1)
+
+    def _targets(self, required_msg, all_namespaces=False):
+        """List the (resource, namespace, name) targeted by the module parameters,
+        in the namespace of the module unless all_namespaces."""
+        if self.filename or self.definition:
+            return [self._locate(obj) for obj in self._objects()]
+
+        if not self.resource:
+            self.module.fail_json(msg=required_msg)
+        resource = self.client.resolve(self.resource)
+        namespace = self.namespace if resource['namespaced'] else None
+        if self.name:
+            return [(resource, namespace, self.name)]
+
+        query = {}
+        if self.label:
+            query['labelSelector'] = self.label
+        listing = self.client.request('GET', self.client.path(resource, None if all_namespaces else namespace),
+                                      query=query)
+        return [(resource, item['metadata'].get('namespace'), item['metadata']['name'])
+                for item in listing.get('items', [])]
+
+    def create(self, check=True, force=True):
+        if check and self.exists():
+            return []
+        return self._apply(force)
+
+    def replace(self, force=True):
+        return self._apply(force)
+
+    def delete(self):
 
         if not self.force and not self.exists():
             return []
 
-        cmd = ['stop']
+        if not (self.filename or self.definition) and not (self.name or self.label or self.all):
+            self.module.fail_json(msg='name, label or all required to delete without filename')
 
-        if self.filename:
-            cmd.append('--filename=' + ','.join(self.filename))
-            if self.recursive:
-                cmd.append('--recursive={}'.format(self.recursive))
-        else:
-            if not self.resource:
-                self.module.fail_json(msg='resource required to stop without filename')
+        result = []
+        try:
+            targets = self._targets('resource required to delete without filename')
+            if self.bulk:
+                return self._bulk_delete(targets)
+            for resource, namespace, name in targets:
+                path = self.client.path(resource, namespace, name)
+                try:
+                    current = self.client.request('DELETE', path, body={'propagationPolicy': 'Background'})
+                except KubeApiError as exc:
+                    if exc.status == 404 and self.force and not (self.filename or self.definition):
+                        continue
+                    raise
+                # Like kubectl delete, only return once the object is gone
+                self._wait_deleted(path, (current.get('metadata') or {}).get('uid'))
+                result.append('%s "%s" deleted' % (self._display(resource), name))
+        except KubeApiError as exc:
+            self._fail(exc)
+        return result
 
-            cmd.append(self.resource)
+    def exists(self):
+        """Check existence reading object metadata only: one GET or LIST per kind and
+        namespace for manifests, a LIST limited to a single item for selectors."""
+        try:
+            if self.filename or self.definition:
+                groups = {}
+                for resource, namespace, name in (self._locate(obj) for obj in self._objects()):
+                    key = (resource['api_version'], resource['kind'], namespace)
+                    groups.setdefault(key, (resource, namespace, set()))[2].add(name)
+                if not groups:
+                    return False
+                return all(self._all_exist(*group) for group in groups.values())
 
+            if not self.resource:
+                self.module.fail_json(msg='resource required without filename')
+            resource = self.client.resolve(self.resource)
+            namespace = self.namespace if resource['namespaced'] else None
             if self.name:
-                cmd.append(self.name)
+                return self._all_exist(resource, namespace, set([self.name]))
 
+            query = {'limit': 1}
             if self.label:
-                cmd.append('--selector=' + self.label)
+                query['labelSelector'] = self.label
+            listing = self.client.request('GET', self.client.path(resource, None if self.all else namespace),
+                                          query=query, accept=METADATA_LIST_ACCEPT)
+            return bool(listing.get('items'))
+        except KubeApiError:
+            return False
 
-            if self.all:
-                cmd.append('--all')
+    def _all_exist(self, resource, namespace, names):
+        if len(names) == 1:
+            self.client.request('GET', self.client.path(resource, namespace, next(iter(names))),
+                                accept=METADATA_ACCEPT)
+            return True
+        listing = self.client.request('GET', self.client.path(resource, namespace),
+                                      accept=METADATA_LIST_ACCEPT)
+        return names <= set(item['metadata']['name'] for item in listing.get('items', []))
+
+    def scale(self):
+        """Scale every workload selected concurrently through their scale subresource,
+        then with wait, watch all of them until they run the replicas asked for."""
+        if self.replicas is None:
+            self.module.fail_json(msg='replicas required to scale')
+        if not (self.filename or self.definition) and not (self.name or self.label or self.all):
+            self.module.fail_json(msg='name, label or all required to scale without filename')
+
+        def scale(target):
+            resource, namespace, name = target
+            display = '%s/%s' % (self._display(resource), name)
+            path = self.client.path(resource, namespace, name) + '/scale'
+            try:
+                if self.client.request('GET', path)['spec'].get('replicas') == self.replicas:
+                    return display + ' unchanged'
+                self.client.request('PATCH', path, body={'spec': {'replicas': self.replicas}},
+                                    content_type='application/merge-patch+json')
+            except KubeApiError as exc:
+                return exc
+            return display + ' scaled'
+
+        try:
+            targets = [target for target in self._targets('resource required to scale without filename',
+                                                          all_namespaces=self.all)
+                       if target[0]['kind'] in SCALE_KINDS]
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                result = list(pool.map(scale, targets))
+            errors = [exc for exc in result if isinstance(exc, KubeApiError)]
+            if errors:
+                raise errors[0]
+        except KubeApiError as exc:
+            self._fail(exc)
+
+        if self.wait:
+            deadline = time.time() + self.wait_timeout
+            with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                pending = [p for p in pool.map(lambda t: self._wait_scaled(t, deadline), targets) if p]
+            if pending:
+                self.module.fail_json(msg='%d object(s) not scaled to %d replicas after %ds: %s' % (
+                    len(pending), self.replicas, self.wait_timeout, ', '.join(pending)))
+        return result
+
+    def _wait_scaled(self, target, deadline):
+        """Watch a workload until it is scaled, return its name if it is not by the deadline."""
+        resource, namespace, name = target
+        scaled = lambda obj: object_scaled(obj, self.replicas)
+        try:
+            current = self.client.request('GET', self.client.path(resource, namespace, name))
+            while not scaled(current):
+                if time.time() >= deadline:
+                    return '%s/%s' % (self._display(resource), name)
+                current = self._watch_until_ready(resource, current, deadline, ready=scaled)
+        except KubeApiError as exc:
+            return '%s/%s: %s' % (self._display(resource), name, exc)
+        return None
+
+    def discover(self):
+        try:
+            resources = self.client.discover()
+        except KubeApiError as exc:
+            self._fail(exc)
+        return ['%d resources discovered' % len(resources)]
+
+
+def expire_kubectl_cache(cache_dir, ttl):
+    """Drop the discovery and OpenAPI caches of kubectl once they are older than ttl seconds.
+
+    kubectl keeps its own, longer, expiry: ttl can only make the cache expire sooner."""
+    stamp = os.path.join(cache_dir, 'kubespray', 'kubectl-cache-time')
+    try:
+        if time.time() - os.path.getmtime(stamp) < ttl:
+            return
+    except OSError:
+        pass
+    for subdir in ('discovery', 'http'):
+        shutil.rmtree(os.path.join(cache_dir, subdir), ignore_errors=True)
+    if not os.path.isdir(os.path.dirname(stamp)):
+        os.makedirs(os.path.dirname(stamp))
+    with open(stamp, 'w'):
+        pass
 
-            if self.force:
-                cmd.append('--ignore-not-found')
 
-        return self._execute(cmd)
+def append_timings(path, timings, **context):
+    """Append the timings of an invocation to a JSON lines file."""
+    with open(path, 'a') as timings_file:
+        for timing in timings:
+            timings_file.write(json.dumps(dict(context, **timing), sort_keys=True) + '\n')
+
+
+def result_changed(state, result):
+    if state in ('exists', 'discovered'):
+        return False
+    return any(not line.endswith('unchanged') for line in result)
+
+
+def format_result(state, result):
+    if state == 'exists':
+        return '%s' % result
+    return 'success: %s' % (' '.join(result))
 
 
 def main():
 
+    states = ['present', 'absent', 'latest', 'reloaded', 'scaled', 'exists', 'discovered']
+
     module = AnsibleModule(
         argument_spec=dict(
             name=dict(),
             filename=dict(type='list', aliases=['files', 'file', 'filenames']),
+            definition=dict(type='raw', aliases=['content']),
             namespace=dict(),
             resource=dict(),
             label=dict(),
@@ -323,40 +2074,91 @@ def main():
             wait=dict(default=False, type='bool'),
             all=dict(default=False, type='bool'),
             log_level=dict(default=0, type='int'),
-            state=dict(default='present', choices=['present', 'absent', 'latest', 'reloaded', 'stopped', 'exists']),
+            state=dict(default='present', choices=states),
             recursive=dict(default=False, type='bool'),
+            engine=dict(default='kubectl', choices=['kubectl', 'api']),
+            fingerprint=dict(default='none', choices=['none', 'file', 'annotation']),
+            fingerprint_file=dict(default='~/.kube/kubespray-fingerprints.json', type='path'),
+            wait_for=dict(default='none', choices=['none', 'ready']),
+            wait_timeout=dict(default=300, type='int'),
+            parallel=dict(default=8, type='int'),
+            phased=dict(default=False, type='bool'),
+            replicas=dict(type='int'),
+            bulk=dict(default=False, type='bool'),
+            server_side=dict(default=False, type='bool'),
+            field_manager=dict(default='kubespray'),
+            force_conflicts=dict(default=True, type='bool'),
+            prune=dict(default=False, type='bool'),
+            applyset=dict(),
+            chunk_size=dict(default=0, type='int'),
+            checkpoint_file=dict(default='~/.kube/kubespray-checkpoints.json', type='path'),
+            cache_dir=dict(default='~/.kube/cache', type='path'),
+            cache_ttl=dict(type='int'),
+            items=dict(type='list', elements='dict', options=dict(
+                name=dict(),
+                filename=dict(type='list', aliases=['files', 'file', 'filenames']),
+                definition=dict(type='raw', aliases=['content']),
+                namespace=dict(),
+                resource=dict(),
+                label=dict(),
+                force=dict(type='bool'),
+                wait=dict(type='bool'),
+                all=dict(type='bool'),
+                state=dict(choices=states),
+                replicas=dict(type='int'),
+                recursive=dict(type='bool'),
+                wait_for=dict(choices=['none', 'ready']),
+            )),
         ),
+        mutually_exclusive=[
+            ['items', 'filename'],
+            ['items', 'resource'],
+            ['items', 'definition'],
+            ['definition', 'filename'],
+            ['definition', 'resource'],
+        ],
     )
 
     changed = False
 
-    manager = KubeManager(module)
-    state = module.params.get('state')
-    if state == 'present':
-        result = manager.create(check=False)
-
-    elif state == 'absent':
-        result = manager.delete()
-
-    elif state == 'reloaded':
-        result = manager.replace()
-
-    elif state == 'stopped':
-        result = manager.stop()
-
-    elif state == 'latest':
-        result = manager.replace()
-
-    elif state == 'exists':
-        result = manager.exists()
-        module.exit_json(changed=changed,
-                     msg='%s' % result)
-
+    if module.params.get('engine') == 'api':
+        manager = KubeApiManager(module)
     else:
-        module.fail_json(msg='Unrecognized state %s.' % state)
+        manager = KubeManager(module)
+    state = module.params.get('state')
+    try:
+        if module.params.get('items') is not None:
+            items = []
+            for item in module.params.get('items'):
+                item_state = item.get('state') or state
+                start = time.time()
+                item_manager = manager.for_item(item)
+                result = item_manager.run(item_state)
+                changed = changed or result_changed(item_state, result)
+                items.append(dict(
+                    state=item_state,
+                    changed=result_changed(item_state, result),
+                    msg=format_result(item_state, result),
+                    duration=round(time.time() - start, 3),
+                    readiness=item_manager.readiness,
+                ))
+            module.exit_json(changed=changed,
+                             msg='success: %d items' % len(items),
+                             items=items,
+                             timings=manager.timings)
+
+        result = manager.run(state)
+        changed = result_changed(state, result)
+    finally:
+        manager.close()
+        if os.environ.get(TIMINGS_FILE_ENV):
+            append_timings(os.environ[TIMINGS_FILE_ENV], manager.timings,
+                           engine=module.params.get('engine'), state=state, pid=os.getpid())
 
     module.exit_json(changed=changed,
-                     msg='success: %s' % (' '.join(result))
+                     msg=format_result(state, result),
+                     readiness=manager.readiness,
+                     timings=manager.timings,
                      )
 
 
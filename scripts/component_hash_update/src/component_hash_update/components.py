@@ -1,10 +1,14 @@
 """
 Static download metadata for components updated by the update-hashes command.
+
+"artifact" is the file hashed, when "url" is a hash file covering several
+archs; it is used to verify mirrors.
 """
 
 infos = {
     "calicoctl_binary": {
         "url": "https://github.com/projectcalico/calico/releases/download/v{version}/SHA256SUMS",
+        "artifact": "https://github.com/projectcalico/calico/releases/download/v{version}/calicoctl-linux-{arch}",
         "graphql_id": "R_kgDOA87D0g",
     },
     "calico_crds": {
@@ -48,6 +52,7 @@ infos = {
     },
     "etcd_binary": {
         "url": "https://github.com/etcd-io/etcd/releases/download/v{version}/SHA256SUMS",
+        "artifact": "https://github.com/etcd-io/etcd/releases/download/v{version}/etcd-v{version}-linux-{arch}.tar.gz",
         "graphql_id": "R_kgDOAKtHtg",
     },
     "gvisor_containerd_shim_binary": {
@@ -81,10 +86,12 @@ infos = {
     },
     "nerdctl_archive": {
         "url": "https://github.com/containerd/nerdctl/releases/download/v{version}/SHA256SUMS",
+        "artifact": "https://github.com/containerd/nerdctl/releases/download/v{version}/nerdctl-{version}-linux-{arch}.tar.gz",
         "graphql_id": "R_kgDOEvuRnQ",
     },
     "runc": {
         "url": "https://github.com/opencontainers/runc/releases/download/v{version}/runc.sha256sum",
+        "artifact": "https://github.com/opencontainers/runc/releases/download/v{version}/runc.{arch}",
         "graphql_id": "R_kgDOAjP4QQ",
     },
     "skopeo_binary": {
@@ -98,6 +105,7 @@ infos = {
     },
     "yq": {
         "url": "https://github.com/mikefarah/yq/releases/download/v{version}/checksums-bsd",  # see https://github.com/mikefarah/yq/pull/1691 for why we use this url
+        "artifact": "https://github.com/mikefarah/yq/releases/download/v{version}/yq_linux_{arch}",
         "graphql_id": "R_kgDOApOQGQ",
     },
     "argocd_install": {
@@ -6,27 +6,72 @@
 
 import sys
 import os
+import base64
+import json
 import logging
+import re
 import subprocess
+import threading
+import time
 
-from itertools import groupby, chain
-from more_itertools import partition
-from functools import cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import chain
 import argparse
 import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.util import Retry
 import hashlib
-from datetime import datetime
+from datetime import datetime, timezone
 from ruamel.yaml import YAML
 from packaging.version import Version, InvalidVersion
 from importlib.resources import files
 from pathlib import Path
+from urllib.parse import urlparse
 
 from typing import Optional, Any
 
 from . import components
+from .transport import RecordAdapter, ReplayAdapter, StandInAdapter
 
 CHECKSUMS_YML = Path("roles/kubespray_defaults/vars/main/checksums.yml")
 
+# Binaries are hashed as they are downloaded, this much at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Suffixes of hash files, named after the file they hold the hash of
+HASH_FILE_SUFFIXES = (".sha256sum", ".sha256", ".sha512")
+
+# Assets of GitHub releases, for which the API publishes a sha256 digest
+GITHUB_RELEASE_ASSET = re.compile(
+    r"https://github\.com/(?P<repo>[^/]+/[^/]+)/releases/download/(?P<tag>[^/]+)/(?P<asset>[^/]+)"
+)
+
+GITHUB_GRAPHQL = "https://api.github.com/graphql"
+
+# GitHub charges a query one point per 100 connections it requests, and
+# returns at most 100 nodes for each of them: pages are fetched this many
+# at a time, so that each query costs a single point.
+GRAPHQL_PAGE_SIZE = 100
+GRAPHQL_PAGES_PER_QUERY = 50
+
+# nodes(ids:) accepts at most 100 ids
+GRAPHQL_MAX_IDS = 100
+
+# Attempts at a query GitHub refused because of its secondary rate limits
+GRAPHQL_ATTEMPTS = 5
+
+# Transient failures are retried this many times, after 1, 2, 4... seconds
+RETRIES = 5
+RETRY_BACKOFF = 1
+
+DEFAULT_CACHE = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "kubespray"
+    / "component_hash_update.json"
+)
+DEFAULT_JOURNAL = DEFAULT_CACHE.with_suffix(".journal")
+
 logger = logging.getLogger(__name__)
 
 
@@ -55,10 +100,500 @@ arch_alt_name = {
 
 # TODO:
 # different verification methods (gpg, cosign) ( needs download role changes) (or verify the sig in this script and only use the checksum in the playbook)
-# perf improvements (async)
 
 
-def download_hash(downloads: {str: {str: Any}}) -> None:
+class HostLimiter:
+    """Bound the number of concurrent requests sent to each host."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphores: {str: threading.BoundedSemaphore} = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.limit)
+            )
+        with semaphore:
+            yield
+
+
+def retries() -> Retry:
+    """Retry policy of the requests sent: transient errors are retried with backoff."""
+    return Retry(
+        total=RETRIES,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        # graphQL queries are only reads
+        allowed_methods=("GET", "HEAD", "POST"),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def header_digest(headers, hashtype: str) -> Optional[str]:
+    """Digest of a download advertised in the headers of a response to a HEAD request.
+
+    Google Cloud Storage x-goog-hash only carries crc32c and md5, it never
+    provides the sha256 or sha512 needed here.
+    """
+    if value := headers.get(f"x-checksum-{hashtype}"):
+        return value.lower()
+    algorithm = {"sha256": "sha-256", "sha512": "sha-512"}.get(hashtype)
+    # Repr-Digest (RFC 9530) then Digest (RFC 3230)
+    for name in ("Repr-Digest", "Digest"):
+        for item in headers.get(name, "").split(","):
+            key, _, value = item.strip().partition("=")
+            if key.lower() == algorithm:
+                return base64.b64decode(value.strip(":")).hex()
+    return None
+
+
+class HashCache:
+    """Hash files content and binaries digests, keyed by URL and kept across runs.
+
+    Entries are revalidated with the ETag and Last-Modified the server sent
+    with them: an unchanged download is neither transferred nor hashed again.
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.entries: {str: {str: Any}} = {}
+        self._lock = threading.Lock()
+        if path is not None and path.exists():
+            try:
+                self.entries = json.loads(path.read_text())
+            except ValueError:
+                logger.warning("Ignoring corrupted cache %s", path)
+
+    def get(self, url: str, key: str) -> Optional[Any]:
+        with self._lock:
+            return self.entries.get(url, {}).get(key)
+
+    def get_validated(
+        self, url: str, validators: (Optional[str], Optional[str]), key: str
+    ) -> Optional[Any]:
+        """Cached value, only if it was stored with the same validators."""
+        with self._lock:
+            entry = self.entries.get(url, {})
+            if validators != (entry.get("etag"), entry.get("last_modified")):
+                return None
+            return entry.get(key)
+
+    def validators(self, url: str, key: str) -> {str: str}:
+        """Conditional request headers for url, if its cached entry holds key."""
+        with self._lock:
+            entry = self.entries.get(url, {})
+        headers = {}
+        if key in entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url: str, response: requests.Response, key: str, value: Any):
+        self.put_validated(
+            url,
+            (response.headers.get("ETag"), response.headers.get("Last-Modified")),
+            key,
+            value,
+        )
+
+    def put_validated(
+        self,
+        url: str,
+        validators: (Optional[str], Optional[str]),
+        key: str,
+        value: Any,
+    ):
+        with self._lock:
+            entry = self.entries.setdefault(url, {})
+            if validators != (entry.get("etag"), entry.get("last_modified")):
+                # Values computed from a previous version of the download are stale
+                entry.clear()
+                entry["etag"], entry["last_modified"] = validators
+            entry[key] = value
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with self._lock:
+            tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+        tmp.replace(self.path)
+
+
+class Journal:
+    """Hashes fetched by a run, recorded as soon as they are.
+
+    A run which failed part way is resumed from its journal, which is
+    removed once checksums.yml is written. Each hash is recorded with the
+    source it was fetched from (the network, fixtures or a mirror): a run
+    refuses to resume from hashes fetched from another source.
+    """
+
+    def __init__(self, path: Optional[Path], source: str = "network"):
+        self.path = path
+        self.source = source
+        self.entries: {(str, str, Optional[str]): Any} = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None and path.exists():
+            for line in path.read_text().splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by an interrupted run
+                    continue
+                if entry.get("source") != source:
+                    raise RuntimeError(
+                        f"{path} holds hashes fetched from {entry.get('source')}, "
+                        f"not {source}: remove it, or pass --no-journal"
+                    )
+                self.entries[
+                    (entry["component"], entry["version"], entry["arch"])
+                ] = entry["hash"]
+
+    def get(self, component: str, version: Version, arch: Optional[str]) -> Optional[Any]:
+        return self.entries.get((component, str(version), arch))
+
+    def record(self, component: str, version: Version, arch: Optional[str], value: Any):
+        if self.path is None:
+            return
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a")
+            self._file.write(
+                json.dumps(
+                    {
+                        "source": self.source,
+                        "component": component,
+                        "version": str(version),
+                        "arch": arch,
+                        "hash": value,
+                    }
+                )
+                + "\n"
+            )
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def complete(self):
+        self.close()
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+
+def artifact_url(info: {str: Any}, version: Version, arch: Optional[str]) -> str:
+    """URL of the file whose hash the component described by info records."""
+    if "artifact" in info:
+        template = info["artifact"]
+    elif info.get("binary", False):
+        template = info["url"]
+    else:
+        template = next(
+            (
+                info["url"].removesuffix(suffix)
+                for suffix in HASH_FILE_SUFFIXES
+                if info["url"].endswith(suffix)
+            ),
+            info["url"],
+        )
+    return template.format(
+        version=version, os="linux", arch=arch, alt_arch=arch_alt_name.get(arch)
+    )
+
+
+def version_index(data: {str: {str: {Any: Any}}}) -> {str: {str: {Version: Any}}}:
+    """Versions of each arch of each component of checksums.yml, parsed once.
+
+    Maps each version to its key in checksums.yml.
+    """
+    return {
+        component.removesuffix("_checksums"): {
+            arch: {Version(str(key)): key for key in versions}
+            for arch, versions in archs.items()
+        }
+        for component, archs in data.items()
+    }
+
+
+def release_series(component: str, version: Version) -> tuple:
+    """Versions of the same series are patch versions of each other."""
+    # gvisor has no major.minor.patch scheme, its versions are dates
+    if component.startswith("gvisor"):
+        return ()
+    return (version.major, version.minor)
+
+
+def prune_versions(component: str, versions: {Version: Any}, keep: int) -> {Version}:
+    """Versions which are not among the newest keep patch versions of their series."""
+    kept = {}
+    pruned = set()
+    for version in sorted(versions, reverse=True):
+        series = release_series(component, version)
+        kept[series] = kept.get(series, 0) + 1
+        if kept[series] > keep:
+            pruned.add(version)
+    return pruned
+
+
+def load_time(document: str) -> float:
+    """Seconds taken to parse a YAML document, the best of a few runs."""
+    loader = YAML(typ="safe")
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        loader.load(document)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def valid_version(possible_version: str) -> Optional[Version]:
+    try:
+        return Version(possible_version)
+    except InvalidVersion:
+        return None
+
+
+def discover_versions(
+    s: requests.Session,
+    repositories: {(str, str): Version},
+    cache: HashCache,
+) -> {(str, str): {Version}}:
+    """Versions released by each repository, from its releases or its tags.
+
+    repositories maps ("releases" or "tags", graphql_id) to the oldest version
+    still of interest: pages, newest first, are only fetched until one holds
+    nothing newer. The versions are cached with the state of the repository
+    (updatedAt, pushedAt, number of releases and tags), so unchanged
+    repositories are not paged through again.
+    """
+    budget = {"remaining": None, "reset_at": None}
+
+    def graphql(query: str, variables: {str: Any}) -> {str: Any}:
+        for attempt in range(GRAPHQL_ATTEMPTS):
+            if budget["remaining"] is not None and budget["remaining"] < 1:
+                wait = (budget["reset_at"] - datetime.now(timezone.utc)).total_seconds()
+                logger.warning(
+                    "Github graphQL API ratelimit exhausted, waiting %ds for its reset",
+                    wait,
+                )
+                time.sleep(max(wait, 0) + 1)
+                budget["remaining"] = None
+            response = s.post(
+                GITHUB_GRAPHQL,
+                json={"query": query, "variables": variables},
+                headers={
+                    "Authorization": f"Bearer {os.environ['API_KEY']}",
+                },
+            )
+            if response.status_code not in (403, 429) or attempt == GRAPHQL_ATTEMPTS - 1:
+                break
+            if "Retry-After" in response.headers:
+                wait = int(response.headers["Retry-After"])
+            elif response.headers.get("X-RateLimit-Remaining") == "0":
+                wait = int(response.headers["X-RateLimit-Reset"]) - time.time()
+            else:
+                break
+            logger.warning("Github graphQL API rate limited, retrying in %ds", wait)
+            time.sleep(max(wait, 0) + 1)
+        response.raise_for_status()
+        result = response.json()
+        for error in result.get("errors", []):
+            logger.warning("Github graphQL API error: %s", error.get("message"))
+        if result.get("data") is None:
+            raise RuntimeError(f"Github graphQL query failed: {result.get('errors')}")
+        rate_limit = result["data"]["rateLimit"]
+        budget["remaining"] = rate_limit["remaining"]
+        budget["reset_at"] = datetime.fromisoformat(
+            rate_limit["resetAt"].replace("Z", "+00:00")
+        )
+        return result["data"]
+
+    ids = list(dict.fromkeys(gql_id for _, gql_id in repositories))
+    states = {}
+    for start in range(0, len(ids), GRAPHQL_MAX_IDS):
+        batch = ids[start : start + GRAPHQL_MAX_IDS]
+        nodes = graphql(
+            files(__package__).joinpath("repository_status.graphql").read_text(),
+            {"ids": batch},
+        )["nodes"]
+        for gql_id, node in zip(batch, nodes):
+            if node:
+                states[gql_id] = "/".join(
+                    str(x)
+                    for x in (
+                        node["updatedAt"],
+                        node["pushedAt"],
+                        node["releases"]["totalCount"],
+                        node["refs"]["totalCount"],
+                    )
+                )
+
+    def cache_url(gql_id: str) -> str:
+        return f"{GITHUB_GRAPHQL}#{gql_id}"
+
+    versions = {}
+    pending = []
+    for (kind, gql_id), oldest in repositories.items():
+        validators = (states.get(gql_id), str(oldest))
+        cached = cache.get_validated(cache_url(gql_id), validators, kind)
+        if states.get(gql_id) is not None and cached is not None:
+            versions[(kind, gql_id)] = {Version(v) for v in cached}
+        else:
+            versions[(kind, gql_id)] = set()
+            pending.append((kind, gql_id, None))
+    logger.info(
+        "Listing versions of %d repositories (%d unchanged since last run)...",
+        len(repositories),
+        len(repositories) - len(pending),
+    )
+
+    fragments = files(__package__).joinpath("list_releases.graphql").read_text()
+    while pending:
+        batch = pending[:GRAPHQL_PAGES_PER_QUERY]
+        pending = pending[GRAPHQL_PAGES_PER_QUERY:]
+        selections = []
+        variables = {}
+        for i, (kind, gql_id, after) in enumerate(batch):
+            variables[f"id{i}"] = gql_id
+            variables[f"after{i}"] = after
+            if kind == "releases":
+                connection = (
+                    f"releases(first: {GRAPHQL_PAGE_SIZE}, after: $after{i}, "
+                    "orderBy: {field: CREATED_AT, direction: DESC}) { ...ReleasesPage }"
+                )
+            else:
+                connection = (
+                    f'refs(refPrefix: "refs/tags/", first: {GRAPHQL_PAGE_SIZE}, '
+                    f"after: $after{i}, "
+                    "orderBy: {field: TAG_COMMIT_DATE, direction: DESC}) { ...TagsPage }"
+                )
+            selections.append(
+                f"p{i}: node(id: $id{i}) {{ ... on Repository {{ {connection} }} }}"
+            )
+        query = "query({}) {{\n  rateLimit {{ cost remaining resetAt }}\n  {}\n}}\n{}".format(
+            ", ".join(
+                f"$id{i}: ID!, $after{i}: String" for i in range(len(batch))
+            ),
+            "\n  ".join(selections),
+            fragments,
+        )
+        data = graphql(query, variables)
+        for i, (kind, gql_id, _) in enumerate(batch):
+            page = (data[f"p{i}"] or {}).get("releases" if kind == "releases" else "refs")
+            if page is None:
+                continue
+            if kind == "releases":
+                found = {
+                    v
+                    for r in page["nodes"]
+                    if not r["isPrerelease"]
+                    and (v := valid_version(r["tagName"])) is not None
+                }
+            else:
+                found = {
+                    v
+                    for t in page["nodes"]
+                    if (v := valid_version(t["name"].removeprefix("release-")))
+                    is not None
+                }
+            versions[(kind, gql_id)] |= found
+            if page["pageInfo"]["hasNextPage"] and not (
+                found and max(found) < repositories[(kind, gql_id)]
+            ):
+                pending.append((kind, gql_id, page["pageInfo"]["endCursor"]))
+            elif gql_id in states:
+                cache.put_validated(
+                    cache_url(gql_id),
+                    (states[gql_id], str(repositories[(kind, gql_id)])),
+                    kind,
+                    sorted(str(v) for v in versions[(kind, gql_id)]),
+                )
+
+    if budget["remaining"] is not None:
+        logger.info(
+            "Github graphQL API ratelimit status: %s remaining. Next reset at %s",
+            budget["remaining"],
+            budget["reset_at"],
+        )
+    return versions
+
+
+def verify_hashes(
+    fetch_digest,
+    expected: {(str, Version, str): str},
+    downloads: {str: {str: Any}},
+    jobs: int,
+) -> None:
+    """Hash the files of each (component, version, arch), checking them against expected."""
+    logger.info("Verifying %d files, %d at a time...", len(expected), jobs)
+
+    def verify(job: (str, Version, str)) -> str:
+        component, version, arch = job
+        hashtype, _, checksum = str(expected[job]).partition(":")
+        try:
+            digest = fetch_digest(
+                artifact_url(downloads[component], version, arch), hashtype
+            )
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                return "missing"
+            raise
+        return "ok" if digest == checksum else "mismatch"
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = dict(zip(expected, executor.map(verify, expected)))
+    for (component, version, arch), result in results.items():
+        if result == "mismatch":
+            logger.error("%s %s %s does not match its hash", component, version, arch)
+        elif result == "missing":
+            logger.debug("%s %s %s is not mirrored", component, version, arch)
+    counts = {r: list(results.values()).count(r) for r in ("ok", "mismatch", "missing")}
+    logger.info(
+        "Verified %d files: %d match, %d do not, %d are missing",
+        len(results),
+        counts["ok"],
+        counts["mismatch"],
+        counts["missing"],
+    )
+    if counts["mismatch"]:
+        raise RuntimeError(f"{counts['mismatch']} files do not match their hash")
+
+
+def download_hash(
+    downloads: {str: {str: Any}},
+    jobs: int = 16,
+    per_host: int = 4,
+    cache: Optional[HashCache] = None,
+    transport: Optional[BaseAdapter] = None,
+    journal: Optional[Journal] = None,
+    mirror: bool = False,
+    verify: bool = False,
+    prune: Optional[int] = None,
+) -> None:
+    """Add the hashes of new patch versions, and of versions with a hash of 0.
+
+    With prune, only the newest prune patch versions of each minor version
+    are kept, for each component and arch.
+
+    With mirror, the transport serves a mirror of the downloads: no new
+    version is looked up, and the hash of a file whose hash file is not
+    mirrored is computed from the file itself. With verify, the files whose
+    hashes are in checksums.yml are hashed instead, and checked against them.
+    """
     # Handle file with multiples hashes, with various formats.
     # the lambda is expected to produce a dictionary of hashes indexed by arch name
     download_hash_extract = {
@@ -109,86 +644,158 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
     logger.info("Opening checksums file %s...", checksums_file)
     data, yaml = open_yaml(checksums_file)
     s = requests.Session()
+    if transport is None:
+        # Keep a connection to each host for every request allowed to run at once
+        transport = HTTPAdapter(pool_maxsize=per_host, max_retries=retries())
+    s.mount("https://", transport)
+    s.mount("http://", transport)
+    limiter = HostLimiter(per_host)
+    if cache is None:
+        cache = HashCache(None)
+    if journal is None:
+        journal = Journal(None)
 
-    @cache
-    def _get_hash_by_arch(download: str, version: str) -> {str: str}:
+    def fetch_text(url: str) -> str:
+        with limiter(url):
+            response = s.get(
+                url, allow_redirects=True, headers=cache.validators(url, "text")
+            )
+        if response.status_code == 304:
+            return cache.get(url, "text")
+        response.raise_for_status()
+        text = response.content.decode()
+        cache.put(url, response, "text", text)
+        return text
 
-        hash_file = s.get(
-            downloads[download]["url"].format(
-                version=version,
-                os="linux",
-            ),
-            allow_redirects=True,
-        )
-        hash_file.raise_for_status()
-        return download_hash_extract[download](hash_file.content.decode())
+    release_digests: {(str, str): {str: Optional[str]}} = {}
+    release_locks: {(str, str): threading.Lock} = {}
+    release_lock = threading.Lock()
 
-    releases, tags = map(
-        dict, partition(lambda r: r[1].get("tags", False), downloads.items())
-    )
-    unique_release_ids = list(dict.fromkeys(
-        r["graphql_id"] for r in releases.values()
-    ))
-    unique_tag_ids = list(dict.fromkeys(
-        t["graphql_id"] for t in tags.values()
-    ))
-    response = s.post(
-        "https://api.github.com/graphql",
-        json={
-            "query": files(__package__).joinpath("list_releases.graphql").read_text(),
-            "variables": {
-                "with_releases": unique_release_ids,
-                "with_tags": unique_tag_ids,
-            },
-        },
-        headers={
-            "Authorization": f"Bearer {os.environ['API_KEY']}",
-        },
-    )
-    if "x-ratelimit-used" in response.headers._store:
-        logger.info(
-            "Github graphQL API ratelimit status: used %s of %s. Next reset at %s",
-            response.headers["X-RateLimit-Used"],
-            response.headers["X-RateLimit-Limit"],
-            datetime.fromtimestamp(int(response.headers["X-RateLimit-Reset"])),
-        )
-    response.raise_for_status()
+    def github_release_digests(repo: str, tag: str) -> {str: Optional[str]}:
+        """Digests of the assets of a release, fetched once per release."""
+        with release_lock:
+            lock = release_locks.setdefault((repo, tag), threading.Lock())
+        with lock:
+            if (repo, tag) not in release_digests:
+                url = f"https://api.github.com/repos/{repo}/releases/tags/{tag}"
+                try:
+                    with limiter(url):
+                        response = s.get(
+                            url,
+                            headers={
+                                "Accept": "application/vnd.github+json",
+                                "Authorization": f"Bearer {os.environ['API_KEY']}",
+                            },
+                        )
+                    response.raise_for_status()
+                    assets = response.json()["assets"]
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    logger.warning("No release metadata for %s %s: %s", repo, tag, e)
+                    assets = []
+                release_digests[(repo, tag)] = {
+                    a["name"]: a.get("digest") for a in assets
+                }
+        return release_digests[(repo, tag)]
 
-    def valid_version(possible_version: str) -> Optional[Version]:
+    def published_digest(url: str, hashtype: str) -> Optional[str]:
+        """Digest published by the host of a download, without downloading it."""
+        if release_asset := GITHUB_RELEASE_ASSET.fullmatch(url):
+            digest = github_release_digests(
+                release_asset["repo"], release_asset["tag"]
+            ).get(release_asset["asset"])
+            # Assets uploaded before GitHub started computing digests have none
+            if digest and digest.startswith(f"{hashtype}:"):
+                return digest.removeprefix(f"{hashtype}:")
+            return None
         try:
-            return Version(possible_version)
-        except InvalidVersion:
+            with limiter(url):
+                response = s.head(url, allow_redirects=True)
+        except requests.RequestException:
             return None
+        if not response.ok:
+            return None
+        return header_digest(response.headers, hashtype)
 
-    resp_data = response.json()["data"]
-    release_versions_by_id = {
-        gql_id: {
-            v
-            for r in repo["releases"]["nodes"]
-            if not r["isPrerelease"]
-            and (v := valid_version(r["tagName"])) is not None
-        }
-        for gql_id, repo in zip(unique_release_ids, resp_data["with_releases"])
-    }
-    tag_versions_by_id = {
-        gql_id: {
-            v
-            for t in repo["refs"]["nodes"]
-            if (v := valid_version(t["name"].removeprefix("release-")))
-            is not None
+    def fetch_digest(url: str, hashtype: str) -> str:
+        # A mirror holds the files, not the digests their hosts publish, and
+        # verifying is hashing the files themselves
+        if not (mirror or verify) and (digest := published_digest(url, hashtype)):
+            return digest
+        key = f"{hashtype}_digest"
+        # A file corrupted in place may keep its ETag: verify never trusts the cache
+        validators = {} if verify else cache.validators(url, key)
+        # urllib3 retries failed requests, not transfers broken part way
+        for attempt in range(RETRIES + 1):
+            digest = hashlib.new(hashtype)
+            try:
+                with limiter(url), s.get(
+                    url,
+                    allow_redirects=True,
+                    stream=True,
+                    headers=validators,
+                ) as response:
+                    if response.status_code == 304:
+                        return cache.get(url, key)
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=HASH_CHUNK_SIZE):
+                        digest.update(chunk)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if attempt == RETRIES:
+                    raise
+                logger.warning("Download of %s interrupted, retrying", url)
+                time.sleep(RETRY_BACKOFF * 2**attempt)
+        if not verify:
+            cache.put(url, response, key, digest.hexdigest())
+        return digest.hexdigest()
+
+    index = version_index(data)
+    if verify:
+        return verify_hashes(
+            fetch_digest,
+            {
+                (c, v, arch): data[c + "_checksums"][arch][key]
+                for c, archs in index.items()
+                if c in downloads
+                for arch, versions in archs.items()
+                for v, key in versions.items()
+                if data[c + "_checksums"][arch][key] != 0
+            },
+            downloads,
+            jobs,
+        )
+
+    if mirror:
+        # New versions are added by hand, with a hash of 0
+        github_versions = {name: set() for name in downloads if name in index}
+    else:
+        oldest_versions = {}
+        for name, info in downloads.items():
+            if name not in index:
+                continue
+            repository = (
+                "tags" if info.get("tags", False) else "releases",
+                info["graphql_id"],
+            )
+            oldest = min(min(versions) for versions in index[name].values())
+            oldest_versions[repository] = min(
+                oldest_versions.get(repository, oldest), oldest
+            )
+        versions_by_repository = discover_versions(s, oldest_versions, cache)
+        github_versions = {
+            name: versions_by_repository[
+                ("tags" if info.get("tags", False) else "releases", info["graphql_id"])
+            ]
+            for name, info in downloads.items()
+            if name in index
         }
-        for gql_id, repo in zip(unique_tag_ids, resp_data["with_tags"])
-    }
-    github_versions = {}
-    for name, info in releases.items():
-        github_versions[name] = release_versions_by_id[info["graphql_id"]]
-    for name, info in tags.items():
-        github_versions[name] = tag_versions_by_id[info["graphql_id"]]
-
-    components_supported_arch = {
-        component.removesuffix("_checksums"): [a for a in archs.keys()]
-        for component, archs in data.items()
-    }
+
+    def latest_patches(versions: {Version: Any}) -> [Version]:
+        latest = {}
+        for v in versions:
+            latest[(v.major, v.minor)] = max(v, latest.get((v.major, v.minor), v))
+        return list(latest.values())
+
     new_versions = {
         c: {
             v
@@ -199,79 +806,194 @@ def download_hash(downloads: {str: {str: Any}}) -> None:
                     (v.major, v.minor) == (version.major, version.minor)
                     or c.startswith("gvisor")
                 )
-                for version in [
-                    max(minors)
-                    for _, minors in groupby(cur_v, lambda v: (v.minor, v.major))
-                ]
+                for version in latest_patches(current)
             )
             # only get:
             # - patch versions (no minor or major bump) (exception for gvisor which does not have a major.minor.patch scheme
             # - newer ones (don't get old patch version)
         }
-        - set(cur_v)
-        for component, archs in data.items()
-        if (c := component.removesuffix("_checksums")) in downloads.keys()
-        # this is only to bound cur_v in the scope
-        and (
-            cur_v := sorted(
-                Version(str(k)) for k in next(archs.values().__iter__()).keys()
-            )
-        )
+        - current.keys()
+        for c, archs in index.items()
+        if c in downloads.keys()
+        # this is only to bound current in the scope
+        and (current := next(iter(archs.values()))) is not None
     }
 
     hash_set_to_0 = {
         c: {
-            Version(str(v))
-            for v, h in chain.from_iterable(a.items() for a in archs.values())
-            if h == 0
+            v
+            for arch, versions in archs.items()
+            for v, key in versions.items()
+            if data[c + "_checksums"][arch][key] == 0
         }
-        for component, archs in data.items()
-        if (c := component.removesuffix("_checksums")) in downloads.keys()
+        for c, archs in index.items()
+        if c in downloads.keys()
     }
 
-    def get_hash(component: str, version: Version, arch: str):
+    def get_hash(component: str, version: Version, arch: Optional[str]):
         if component in download_hash_extract:
-            hashes = _get_hash_by_arch(component, version)
-            return hashes[arch]
+            # One file for all archs: the hashes indexed by arch
+            try:
+                hash_file = fetch_text(
+                    downloads[component]["url"].format(
+                        version=version,
+                        os="linux",
+                    )
+                )
+            except requests.HTTPError as e:
+                if not mirror or e.response.status_code != 404:
+                    raise
+                # Mirrors hold the files downloaded, not always their hash files
+                return fetch_digest(
+                    artifact_url(downloads[component], version, arch),
+                    downloads[component].get("hashtype", "sha256"),
+                )
+            hashes = download_hash_extract[component](hash_file)
+            # Hashed one arch at a time from a mirror
+            return hashes if arch is None else hashes[arch]
         else:
-            hash_file = s.get(
-                downloads[component]["url"].format(
-                    version=version,
-                    os="linux",
-                    arch=arch,
-                    alt_arch=arch_alt_name[arch],
-                ),
-                allow_redirects=True,
+            url = downloads[component]["url"].format(
+                version=version,
+                os="linux",
+                arch=arch,
+                alt_arch=arch_alt_name[arch],
             )
-            hash_file.raise_for_status()
+            hashtype = downloads[component].get("hashtype", "sha256")
             if downloads[component].get("binary", False):
-                return hashlib.new(
-                    downloads[component].get("hashtype", "sha256"), hash_file.content
-                ).hexdigest()
-            return hash_file.content.decode().split()[0]
+                return fetch_digest(url, hashtype)
+            try:
+                return fetch_text(url).split()[0]
+            except requests.HTTPError as e:
+                if not mirror or e.response.status_code != 404:
+                    raise
+                # Mirrors hold the files downloaded, not always their hash files
+                return fetch_digest(
+                    artifact_url(downloads[component], version, arch), hashtype
+                )
+
+    def hash_job(component: str, version: Version, arch: str):
+        # A mirror may not hold the hash file for all archs, only the files of each arch
+        if component in download_hash_extract and not mirror:
+            return (component, version, None)
+        return (component, version, arch)
 
+    hash_jobs = list(
+        dict.fromkeys(
+            hash_job(component, version, arch)
+            for component, versions in chain(
+                new_versions.items(), hash_set_to_0.items()
+            )
+            for arch in index[component]
+            for version in versions
+        )
+    )
+    hashes = {
+        job: resumed
+        for job in hash_jobs
+        if (resumed := journal.get(*job)) is not None
+    }
+    if hashes:
+        logger.info("Resuming from %s: %d hashes already fetched", journal.path, len(hashes))
+    logger.info(
+        "Fetching %d hashes, %d at a time, at most %d per host...",
+        len(hash_jobs) - len(hashes),
+        jobs,
+        per_host,
+    )
+
+    def fetch_hash(job: (str, Version, Optional[str])):
+        value = get_hash(*job)
+        journal.record(*job, value)
+        return value
+
+    failures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(fetch_hash, job): job
+                for job in hash_jobs
+                if job not in hashes
+            }
+            for future in as_completed(futures):
+                try:
+                    hashes[futures[future]] = future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+    finally:
+        # Keep what was fetched, even when a fetch failed
+        cache.save()
+        journal.close()
+    if failures:
+        for (component, version, arch), e in failures.items():
+            logger.error("Could not fetch the hash of %s %s %s: %s", component, version, arch or "", e)
+        raise RuntimeError(
+            f"{len(failures)} hashes could not be fetched, "
+            f"run again to resume from the other {len(hashes)}"
+        )
+
+    # Fill in the results in a fixed order, whatever order they were fetched in
     for component, versions in chain(new_versions.items(), hash_set_to_0.items()):
         c = component + "_checksums"
-        for arch in components_supported_arch[component]:
+        for arch, keys in index[component].items():
             for version in versions:
+                checksum = hashes[hash_job(component, version, arch)]
+                if isinstance(checksum, dict):
+                    checksum = checksum[arch]
+                key = keys.setdefault(version, str(version))
                 data[c][arch][
-                    str(version)
-                ] = f"{downloads[component].get('hashtype', 'sha256')}:{get_hash(component, version, arch)}"
+                    key
+                ] = f"{downloads[component].get('hashtype', 'sha256')}:{checksum}"
+
+    pruned = {}
+    if prune:
+        for component in downloads:
+            for arch, keys in index.get(component, {}).items():
+                for version in prune_versions(component, keys, prune):
+                    del keys[version]
+                    pruned[component] = pruned.get(component, 0) + 1
+        original = checksums_file.read_text()
 
+    # Write each updated component back once, newest versions first
+    changed = {
+        component
+        for component, versions in chain(new_versions.items(), hash_set_to_0.items())
+        if versions
+    }
+    for component in changed | pruned.keys():
+        c = component + "_checksums"
         data[c] = {
             arch: {
-                v: versions[v]
-                for v in sorted(
-                    versions.keys(), key=lambda v: Version(str(v)), reverse=True
-                )
+                key: data[c][arch][key]
+                for _, key in sorted(keys.items(), key=lambda e: e[0], reverse=True)
             }
-            for arch, versions in data[c].items()
+            for arch, keys in index[component].items()
         }
 
     with open(checksums_file, "w") as checksums_yml:
         yaml.dump(data, checksums_yml)
+    journal.complete()
     logger.info("Updated %s", checksums_file)
 
+    if prune:
+        for component, count in sorted(pruned.items()):
+            logger.info("Pruned %d hashes of %s", count, component)
+        updated = checksums_file.read_text()
+        logger.info(
+            "Pruned %d hashes: %d lines (%d before this run), parsed in %.1fms (%.1fms before)",
+            sum(pruned.values()),
+            updated.count("\n"),
+            original.count("\n"),
+            load_time(updated) * 1000,
+            load_time(original) * 1000,
+        )
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
 
 def main():
 
@@ -328,8 +1050,118 @@ def main():
         help="do not obtain hashes for this component",
         default=[],
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        help="number of hashes fetched concurrently",
+        default=16,
+    )
+    parser.add_argument(
+        "--per-host",
+        type=positive_int,
+        help="maximum number of concurrent requests to a single host",
+        default=4,
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="file caching the hash files and binaries digests across runs",
+        default=DEFAULT_CACHE,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not read nor write the cache",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="file recording the hashes fetched, to resume a failed run",
+        default=DEFAULT_JOURNAL,
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="do not resume from nor record a journal",
+    )
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument(
+        "--fixtures",
+        type=Path,
+        help="answer every request from this fixtures directory, offline",
+    )
+    transport.add_argument(
+        "--record",
+        type=Path,
+        help="save the responses received in this fixtures directory",
+    )
+    transport.add_argument(
+        "--mirror",
+        metavar="URL_OR_PATH",
+        help="hash the files of this mirror, laid out like `wget -x` (as contrib/offline does),\n"
+        "instead of downloading them; only versions with a hash of 0 are added",
+    )
+    transport.add_argument(
+        "--stand-in",
+        metavar="URL",
+        help="send every request to this local server, as URL/<host>/<path>",
+    )
+
+    parser.add_argument(
+        "--prune",
+        type=positive_int,
+        metavar="N",
+        help="keep only the newest N patch versions of each minor version,\n"
+        "for each component and arch, and report the parsing time saved",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the files downloaded (usually from --mirror) against the hashes\n"
+        f"already in {CHECKSUMS_YML}, instead of adding new ones",
+    )
 
     args = parser.parse_args()
+    # Recording fetches from the network
+    source = "network"
+    if args.mirror and args.mirror.startswith(("http://", "https://")):
+        adapter = StandInAdapter(
+            args.mirror, pool_maxsize=args.per_host, max_retries=retries()
+        )
+        source = f"mirror {args.mirror}"
+    elif args.mirror:
+        mirror = Path(args.mirror.removeprefix("file://")).resolve()
+        adapter = ReplayAdapter(mirror)
+        source = f"mirror {mirror}"
+    elif args.fixtures:
+        adapter = ReplayAdapter(args.fixtures)
+        os.environ.setdefault("API_KEY", "fixtures")
+        source = f"fixtures {args.fixtures.resolve()}"
+    elif args.record:
+        adapter = RecordAdapter(
+            args.record, pool_maxsize=args.per_host, max_retries=retries()
+        )
+    elif args.stand_in:
+        adapter = StandInAdapter(
+            args.stand_in, pool_maxsize=args.per_host, max_retries=retries()
+        )
+        source = f"stand-in {args.stand_in}"
+    else:
+        adapter = None
     download_hash(
-        {k: components.infos[k] for k in (set(args.only) - set(args.exclude))}
+        # In a fixed order, so that the same queries are sent every run
+        {
+            k: info
+            for k, info in components.infos.items()
+            if k in args.only and k not in args.exclude
+        },
+        jobs=args.jobs,
+        per_host=args.per_host,
+        cache=HashCache(None if args.no_cache else args.cache),
+        transport=adapter,
+        journal=Journal(None if args.no_journal else args.journal, source),
+        mirror=bool(args.mirror),
+        verify=args.verify,
+        prune=args.prune,
     )
@@ -0,0 +1,114 @@
+"""Transports used instead of the network, to run update-hashes offline.
+
+Fixtures directories mirror the URLs they answer for, like `wget -x` does:
+https://github.com/etcd-io/etcd/releases/download/v3.5.16/SHA256SUMS is
+<fixtures>/github.com/etcd-io/etcd/releases/download/v3.5.16/SHA256SUMS.
+GitHub graphQL queries are stored under
+<fixtures>/api.github.com/graphql/<sha256 of the query and its variables>.json
+"""
+
+import hashlib
+import io
+import json
+import logging
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+
+def fixture_path(fixtures: Path, request: requests.PreparedRequest) -> Path:
+    """File of fixtures holding the response to request."""
+    url = urlparse(request.url)
+    if request.method == "POST":
+        body = json.loads(request.body)
+        key = hashlib.sha256(
+            json.dumps(
+                [body["query"], body.get("variables")], sort_keys=True
+            ).encode()
+        ).hexdigest()
+        return fixtures / url.netloc / url.path.lstrip("/") / f"{key}.json"
+    return fixtures / url.netloc / url.path.lstrip("/")
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answer requests from the files of a fixtures directory.
+
+    Files are revalidated on their modification time and size, like a
+    static web server does, so that the cache of update-hashes behaves as it
+    does online.
+    """
+
+    def __init__(self, fixtures: Path):
+        super().__init__()
+        self.fixtures = fixtures
+
+    def send(self, request, stream=False, **kwargs):
+        path = fixture_path(self.fixtures, request)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers = CaseInsensitiveDict()
+        if not path.is_file():
+            logger.debug("No fixture %s for %s", path, request.url)
+            response.status_code = 404
+            response.reason = "Not Found"
+            response.raw = io.BytesIO(b"")
+            return response
+        stat = path.stat()
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        response.headers["ETag"] = etag
+        if request.headers.get("If-None-Match") == etag:
+            response.status_code = 304
+            response.reason = "Not Modified"
+            response.raw = io.BytesIO(b"")
+            return response
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers["Content-Length"] = str(stat.st_size)
+        # Streamed from the file, mirrored files can be hundreds of MB
+        response.raw = io.BytesIO(b"") if request.method == "HEAD" else open(path, "rb")
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordAdapter(HTTPAdapter):
+    """Send requests to the network, saving successful responses as fixtures."""
+
+    def __init__(self, fixtures: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures = fixtures
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if response.status_code == 200 and request.method in ("GET", "POST"):
+            path = fixture_path(self.fixtures, request)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Reads the whole body, even of streamed responses
+            path.write_bytes(response.content)
+        return response
+
+
+class StandInAdapter(HTTPAdapter):
+    """Send every request to a local stand-in server instead of its host.
+
+    https://<host>/<path> is requested as <server>/<host>/<path>, so that a
+    plain static web server over a fixtures directory can answer downloads.
+    """
+
+    def __init__(self, server: str, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server.rstrip("/")
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = f"{self.server}/{url.netloc}{url.path}" + (
+            f"?{url.query}" if url.query else ""
+        )
+        return super().send(request, **kwargs)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""Benchmark update-hashes offline.
+
+Times a full update of checksums.yml, for every component of
+components.infos, against a local stand-in for GitHub and the download
+hosts. The stand-in serves synthetic releases (the versions already in
+checksums.yml, plus new patch versions of each of them) with a
+configurable latency. Each configuration is run cold, then again with the
+cache of the first run, and every run must produce the same checksums.yml.
+
+    tests/scripts/component-hash-benchmark/main.py --jobs 1,16 --latency 0.05
+    tests/scripts/component-hash-benchmark/main.py --transport fixtures
+    tests/scripts/component-hash-benchmark/main.py --fixtures recorded/
+
+Recorded fixtures come from `update-hashes --record recorded/`; they are
+replayed against the checksums.yml they were recorded with.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parents[2]
+sys.path.insert(0, str(ROOT / 'scripts' / 'component_hash_update' / 'src'))
+
+import requests  # noqa: E402
+from packaging.version import Version  # noqa: E402
+from ruamel.yaml import YAML  # noqa: E402
+
+from component_hash_update import components, download  # noqa: E402
+from component_hash_update.transport import ReplayAdapter, StandInAdapter  # noqa: E402
+
+CHECKSUMS = ROOT / download.CHECKSUMS_YML
+
+# Archs of the hash files published upstream, beyond those of checksums.yml
+UPSTREAM_ARCHS = ['amd64', 'arm64', 'arm', 'ppc64le', 'riscv64', 's390x']
+
+# Hash files holding the hashes of every arch, in the format of each upstream
+HASH_FILES = {
+    'calicoctl_binary': lambda version, hashes: ''.join(
+        '%s  calicoctl-linux-%s\n' % (h, arch) for arch, h in hashes.items()),
+    'etcd_binary': lambda version, hashes: ''.join(
+        '%s  etcd-v%s-linux-%s.tar.gz\n' % (h, version, arch) for arch, h in hashes.items()),
+    'nerdctl_archive': lambda version, hashes: ''.join(
+        '%s  nerdctl-%s-linux-%s.tar.gz\n' % (h, version, arch) for arch, h in hashes.items()),
+    'runc': lambda version, hashes: 'sha256sums\n\n\n' + ''.join(
+        '%s  runc.%s\n' % (h, arch) for arch, h in hashes.items()),
+    'yq': lambda version, hashes: ''.join(
+        'SHA256 (yq_linux_%s) = %s\n' % (arch, h) for arch, h in hashes.items()),
+}
+
+
+def synthetic_releases(checksums, new_patches):
+    """Versions released by each repository: those of checksums.yml, plus
+    new_patches patch versions above each of them."""
+    data = YAML().load(checksums.read_text())
+    releases = {}
+    for name, info in components.infos.items():
+        archs = data.get(name + '_checksums')
+        if not archs:
+            continue
+        versions = {Version(str(v)) for v in next(iter(archs.values()))}
+        released = releases.setdefault(info['graphql_id'], set())
+        for version in versions:
+            released.add(version)
+            if len(version.release) == 3:
+                released.update(Version('%d.%d.%d' % (version.major, version.minor, version.micro + i))
+                                for i in range(1, new_patches + 1))
+    return data, releases
+
+
+def synthesize_fixtures(fixtures, data, releases, binary_size, digests):
+    """Write the hash files and binaries of every release, laid out like `wget -x`."""
+    def write(url, content):
+        host, _, path = url.split('://', 1)[1].partition('/')
+        target = fixtures / host / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(content)
+
+    assets = {}
+    for name, info in components.infos.items():
+        archs = list(data.get(name + '_checksums') or {})
+        hashtype = info.get('hashtype', 'sha256')
+        for version in releases.get(info['graphql_id'], ()):
+            if name in HASH_FILES:
+                hashes = {arch: hashlib.sha256(('%s %s %s' % (name, version, arch)).encode()).hexdigest()
+                          for arch in dict.fromkeys(archs + UPSTREAM_ARCHS)}
+                url = info['url'].format(version=version, os='linux')
+                write(url, HASH_FILES[name](version, hashes).encode())
+                continue
+            for arch in archs:
+                url = info['url'].format(version=version, os='linux', arch=arch,
+                                         alt_arch=download.arch_alt_name[arch])
+                if not info.get('binary', False):
+                    digest = hashlib.new(hashtype, url.encode()).hexdigest()
+                    write(url, ('%s  %s\n' % (digest, url.rsplit('/', 1)[1])).encode())
+                    continue
+                seed = hashlib.sha256(url.encode()).digest()
+                content = (seed * (binary_size // len(seed) + 1))[:binary_size]
+                write(url, content)
+                asset = download.GITHUB_RELEASE_ASSET.fullmatch(url)
+                if asset and digests:
+                    assets.setdefault((asset['repo'], asset['tag']), []).append(
+                        {'name': asset['asset'], 'digest': 'sha256:' + hashlib.sha256(content).hexdigest()})
+    for (repo, tag), release_assets in assets.items():
+        write('https://api.github.com/repos/%s/releases/tags/%s' % (repo, tag),
+              json.dumps({'assets': release_assets}).encode())
+
+
+def graphql_response(body, releases, tags):
+    """Answer the graphQL queries of download.discover_versions."""
+    query, variables = body['query'], body['variables']
+    data = {'rateLimit': {'cost': 1, 'remaining': 4999, 'resetAt': '2099-01-01T00:00:00Z'}}
+    if 'ids' in variables:
+        data['nodes'] = [{'updatedAt': '2024-01-01T00:00:00Z', 'pushedAt': '2024-01-01T00:00:00Z',
+                          'releases': {'totalCount': len(releases.get(gql_id, ()))},
+                          'refs': {'totalCount': len(releases.get(gql_id, ()))}}
+                         for gql_id in variables['ids']]
+        return {'data': data}
+    lines = {line.strip().split(':', 1)[0]: line for line in query.splitlines() if line.strip().startswith('p')}
+    i = 0
+    while 'id%d' % i in variables:
+        gql_id = variables['id%d' % i]
+        line = lines['p%d' % i]
+        size = int(line.split('first: ', 1)[1].split(',', 1)[0])
+        start = int(variables['after%d' % i] or 0)
+        versions = sorted(releases.get(gql_id, ()), reverse=True)
+        page = versions[start:start + size]
+        page_info = {'hasNextPage': start + size < len(versions), 'endCursor': str(start + size)}
+        if gql_id in tags:
+            data['p%d' % i] = {'refs': {'pageInfo': page_info,
+                                        'nodes': [{'name': 'release-%s' % v} for v in page]}}
+        else:
+            data['p%d' % i] = {'releases': {'pageInfo': page_info,
+                                            'nodes': [{'tagName': 'v%s' % v, 'isPrerelease': False}
+                                                      for v in page]}}
+        i += 1
+    return {'data': data}
+
+
+class SyntheticReplayAdapter(ReplayAdapter):
+    """Replay synthetic fixtures, answering graphQL queries in process."""
+
+    def __init__(self, fixtures, releases):
+        super().__init__(fixtures)
+        self.releases = releases
+        self.tags = {info['graphql_id'] for info in components.infos.values() if info.get('tags', False)}
+
+    def send(self, request, **kwargs):
+        if request.method != 'POST':
+            return super().send(request, **kwargs)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 200
+        response.raw = io.BytesIO(json.dumps(
+            graphql_response(json.loads(request.body), self.releases, self.tags)).encode())
+        return response
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixtures, releases, latency):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.fixtures = fixtures
+        self.releases = releases
+        self.tags = {info['graphql_id'] for info in components.infos.values() if info.get('tags', False)}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, method, status, sent):
+        with self.lock:
+            self.stats[method] = self.stats.get(method, 0) + 1
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+            self.stats['bytes'] = self.stats.get('bytes', 0) + sent
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, content=b'', headers=None, body=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+        self.server.count(self.command, status, len(content) if body else 0)
+
+    def do_GET(self, body=True):
+        time.sleep(self.server.latency)
+        path = self.server.fixtures / self.path.lstrip('/')
+        if not path.is_file():
+            return self.reply(404, body=body)
+        stat = path.stat()
+        etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers={'ETag': etag}, body=False)
+        self.reply(200, path.read_bytes(), {'ETag': etag}, body=body)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        response = graphql_response(request, self.server.releases, self.server.tags)
+        self.reply(200, json.dumps(response).encode(), {'Content-Type': 'application/json'})
+
+
+@contextlib.contextmanager
+def checkout(checksums):
+    """A git work tree holding only checksums.yml, as update-hashes expects."""
+    with tempfile.TemporaryDirectory() as tree:
+        target = Path(tree) / download.CHECKSUMS_YML
+        target.parent.mkdir(parents=True)
+        shutil.copy(checksums, target)
+        subprocess.run(['git', 'init', '-q', tree], check=True)
+        cwd = os.getcwd()
+        os.chdir(tree)
+        try:
+            yield target
+        finally:
+            os.chdir(cwd)
+
+
+def run(checksums, transport, jobs, per_host, cache):
+    with checkout(checksums) as target:
+        start = time.perf_counter()
+        download.download_hash(dict(components.infos), jobs=jobs, per_host=per_host,
+                               cache=download.HashCache(cache), transport=transport)
+        seconds = time.perf_counter() - start
+        return seconds, target.read_bytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', default='1,16', help='comma separated numbers of concurrent fetches')
+    parser.add_argument('--per-host', type=int, default=4)
+    parser.add_argument('--transport', choices=('stand-in', 'fixtures'), default='stand-in',
+                        help='a local HTTP server, or reading the fixtures in process (no latency)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--new-patches', type=int, default=2, help='patch versions released above each one')
+    parser.add_argument('--binary-size', type=int, default=1024 * 1024, help='bytes of each binary')
+    parser.add_argument('--no-digests', action='store_true',
+                        help='do not publish the digests of release assets, so binaries are downloaded')
+    parser.add_argument('--fixtures', type=Path, help='replay these recorded fixtures instead')
+    parser.add_argument('--checksums', type=Path, default=CHECKSUMS)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    os.environ.setdefault('API_KEY', 'benchmark')
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        server = None
+        releases = None
+        if args.fixtures:
+            fixtures = args.fixtures
+            transport = 'fixtures'
+        else:
+            fixtures = workdir / 'fixtures'
+            data, releases = synthetic_releases(args.checksums, args.new_patches)
+            synthesize_fixtures(fixtures, data, releases, args.binary_size, not args.no_digests)
+            transport = args.transport
+            if transport == 'stand-in':
+                server = StandInServer(fixtures, releases, args.latency)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        results = []
+        outputs = set()
+        for jobs in [int(j) for j in args.jobs.split(',')]:
+            cache = workdir / ('cache-%d.json' % jobs)
+            for label in ('cold', 'warm'):
+                if server:
+                    server.stats = {}
+                    adapter = StandInAdapter('http://127.0.0.1:%d' % server.server_port,
+                                             pool_maxsize=args.per_host)
+                elif releases is not None:
+                    adapter = SyntheticReplayAdapter(fixtures, releases)
+                else:
+                    adapter = ReplayAdapter(fixtures)
+                seconds, output = run(args.checksums, adapter, jobs, args.per_host, cache)
+                outputs.add(output)
+                results.append(dict(run=label, jobs=jobs, seconds=round(seconds, 3),
+                                    **(server.stats if server else {})))
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        columns = ['run', 'jobs', 'seconds'] + sorted({k for r in results for k in r} - {'run', 'jobs', 'seconds'})
+        print(' '.join('%10s' % c for c in columns))
+        for result in results:
+            print(' '.join('%10s' % result.get(c, '') for c in columns))
+    if len(outputs) != 1:
+        sys.exit('checksums.yml differs between runs')
+
+
+if __name__ == '__main__':
+    main()
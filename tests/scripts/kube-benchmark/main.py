@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""Benchmark the kube module offline.
+
+Runs main() of plugins/modules/kube.py in process, for each engine, against
+fake-kubectl (engine=kubectl) or a local fake API server (engine=api), both
+with a configurable latency. For 1, 10 and 100 manifests, it reports the
+latency of each state, the kubectl processes started, the API requests sent
+and the throughput in objects per second.
+
+The outcome of every scenario is checked as well, and the script fails when
+an unchanged apply reports changed, when exists does not find the objects,
+when a delete leaves objects behind, or when an object in another namespace
+is touched.
+
+    tests/scripts/kube-benchmark/main.py --sizes 1,10,100 --kubectl-latency 0.1
+    tests/scripts/kube-benchmark/main.py --engines api --args '{"parallel": 16}'
+"""
+
+import argparse
+import contextlib
+import copy
+import importlib.util
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from ansible.module_utils import basic
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE = os.path.join(HERE, '..', '..', '..', 'plugins', 'modules', 'kube.py')
+FAKE_KUBECTL = os.path.join(HERE, 'fake-kubectl')
+
+# group version: (plural, kind, namespaced, short names)
+RESOURCES = {
+    'v1': [('namespaces', 'Namespace', False, ['ns']), ('configmaps', 'ConfigMap', True, ['cm']),
+           ('secrets', 'Secret', True, []), ('services', 'Service', True, ['svc'])],
+    'apps/v1': [('deployments', 'Deployment', True, ['deploy']), ('daemonsets', 'DaemonSet', True, ['ds'])],
+    'apiextensions.k8s.io/v1': [('customresourcedefinitions', 'CustomResourceDefinition', False, ['crd'])],
+}
+
+# Scenario run for every engine and size: (label, module parameters)
+SCENARIO = [('create', dict(state='latest')), ('unchanged', dict(state='latest')),
+            ('exists', dict(state='exists')), ('delete', dict(state='absent')),
+            ('delete all', dict(state='absent', filename=None, resource='configmaps', all=True))]
+
+# Namespace of an object the scenarios must leave alone
+OTHER_NAMESPACE = 'bench-other'
+
+
+def ready_status(obj):
+    """Status making an object ready as soon as it is written."""
+    replicas = (obj.get('spec') or {}).get('replicas', 1)
+    if obj['kind'] == 'Deployment':
+        return {'replicas': replicas, 'updatedReplicas': replicas, 'availableReplicas': replicas,
+                'readyReplicas': replicas}
+    if obj['kind'] == 'CustomResourceDefinition':
+        return {'conditions': [{'type': 'Established', 'status': 'True'}]}
+    return None
+
+
+def merge(current, patch):
+    for key, value in patch.items():
+        if value is None:
+            current.pop(key, None)
+        elif isinstance(value, dict) and isinstance(current.get(key), dict):
+            merge(current[key], value)
+        else:
+            current[key] = copy.deepcopy(value)
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Enough of the Kubernetes API for the api engine: discovery, CRUD, merge and
+    apply patches, label selectors, limits and watches."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not let delayed ACKs hold the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_any(self, method):
+        server = self.server
+        time.sleep(server.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = [p for p in url.path.split('/') if p]
+        with server.lock:
+            server.requests += 1
+
+        if parts == ['api']:
+            return self.send(200, {'versions': ['v1']})
+        if parts == ['apis']:
+            return self.send(200, {'groups': [
+                {'name': gv.split('/')[0], 'versions': [{'groupVersion': gv}],
+                 'preferredVersion': {'groupVersion': gv}} for gv in RESOURCES if '/' in gv]})
+        if parts[0] == 'api':
+            api_version, rest = 'v1', parts[2:]
+        else:
+            api_version, rest = '/'.join(parts[1:3]), parts[3:]
+        if api_version not in RESOURCES:
+            return self.send(404, {'message': 'not found'})
+        if not rest:
+            return self.send(200, {'resources': [
+                {'name': n, 'kind': k, 'namespaced': ns, 'shortNames': sn, 'singularName': k.lower()}
+                for n, k, ns, sn in RESOURCES[api_version]]})
+
+        namespace = None
+        if rest[0] == 'namespaces' and len(rest) > 2:
+            namespace, rest = rest[1], rest[2:]
+        plural, name = rest[0], (rest[1] if len(rest) > 1 else None)
+        key = (api_version, plural, namespace, name)
+
+        with server.lock:
+            if name is None and query.get('watch') == 'true':
+                # Objects are ready once written: send the current state and end the watch
+                items = self.select(api_version, plural, namespace, query)
+                data = b''.join((json.dumps({'type': 'MODIFIED', 'object': o}) + '\n').encode()
+                                for o in items if 'fieldSelector' in query)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+            if name is None and method == 'GET':
+                return self.send(200, {'kind': 'List', 'metadata': {'resourceVersion': str(server.version)},
+                                       'items': self.select(api_version, plural, namespace, query)})
+            if name is None and method == 'POST':
+                key = (api_version, plural, namespace, body['metadata']['name'])
+                if key in server.objects:
+                    return self.send(409, {'message': 'already exists', 'reason': 'AlreadyExists'})
+                return self.send(201, self.store(key, body, str(uuid.uuid4())))
+
+            current = server.objects.get(key)
+            if current is None:
+                if method == 'PATCH' and self.headers['Content-Type'] == 'application/apply-patch+yaml':
+                    return self.send(201, self.store(key, body, str(uuid.uuid4())))
+                return self.send(404, {'message': 'not found', 'reason': 'NotFound'})
+            if method == 'GET':
+                return self.send(200, current)
+            if method == 'DELETE':
+                del server.objects[key]
+                return self.send(200, current)
+            if method == 'PATCH':
+                patched = copy.deepcopy(current)
+                merge(patched, body)
+                if patched != current:
+                    current = self.store(key, patched, current['metadata']['uid'])
+                return self.send(200, current)
+            if method == 'PUT':
+                return self.send(200, self.store(key, body, current['metadata']['uid']))
+        self.send(405, {'message': 'method not allowed'})
+
+    def select(self, api_version, plural, namespace, query):
+        items = [o for (g, p, ns, _), o in sorted(self.server.objects.items())
+                 if g == api_version and p == plural and (namespace is None or ns == namespace)]
+        if 'labelSelector' in query:
+            label, _, value = query['labelSelector'].partition('=')
+            items = [o for o in items if (o['metadata'].get('labels') or {}).get(label) == value]
+        if 'fieldSelector' in query:
+            name = query['fieldSelector'].partition('=')[2]
+            items = [o for o in items if o['metadata']['name'] == name]
+        if 'limit' in query:
+            items = items[:int(query['limit'])]
+        return items
+
+    def store(self, key, obj, uid):
+        self.server.version += 1
+        obj['metadata'].update(uid=uid, resourceVersion=str(self.server.version))
+        status = ready_status(obj)
+        if status:
+            obj['status'] = status
+        self.server.objects[key] = obj
+        return obj
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PATCH(self):
+        self.handle_any('PATCH')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+def other_namespace_object(server):
+    """Store a ConfigMap named like the manifests in OTHER_NAMESPACE, return its key."""
+    key = ('v1', 'configmaps', OTHER_NAMESPACE, 'bench-000')
+    with server.lock:
+        server.version += 1
+        server.objects[key] = {'apiVersion': 'v1', 'kind': 'ConfigMap',
+                               'metadata': {'name': 'bench-000', 'namespace': OTHER_NAMESPACE,
+                                            'uid': str(uuid.uuid4()),
+                                            'resourceVersion': str(server.version)},
+                               'data': {'index': 'other'}}
+    return key
+
+
+def fake_api_server(latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.objects = {}
+    server.version = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_manifests(directory, size):
+    """Write size manifests, one object each, every fifth one a Deployment."""
+    os.makedirs(directory)
+    for index in range(size):
+        if index % 5 == 4:
+            obj = {'apiVersion': 'apps/v1', 'kind': 'Deployment',
+                   'metadata': {'name': 'bench-%03d' % index, 'labels': {'app': 'bench'}},
+                   'spec': {'replicas': 1, 'selector': {'matchLabels': {'app': 'bench'}}}}
+        else:
+            obj = {'apiVersion': 'v1', 'kind': 'ConfigMap',
+                   'metadata': {'name': 'bench-%03d' % index, 'labels': {'app': 'bench'}},
+                   'data': {'index': str(index)}}
+        with open(os.path.join(directory, 'bench-%03d.json' % index), 'w') as manifest:
+            json.dump(obj, manifest)
+
+
+def load_module():
+    spec = importlib.util.spec_from_file_location('kube', MODULE)
+    kube = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(kube)
+    return kube
+
+
+def run_module(kube, params):
+    """Run main() of the module in process and return its result."""
+    basic._ANSIBLE_ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': params}).encode()
+    if hasattr(basic, '_ANSIBLE_PROFILE'):
+        # ansible-core >= 2.19 also needs the serialization profile of the arguments
+        basic._ANSIBLE_PROFILE = 'legacy'
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            kube.main()
+        except SystemExit:
+            pass
+    return json.loads(out.getvalue())
+
+
+def namespace_objects(server, kubectl_state, namespace):
+    """Names of the objects in namespace, on the fake API server and in the fake kubectl state."""
+    names = [name for (_, _, ns, name) in server.objects if ns == namespace]
+    if os.path.exists(kubectl_state):
+        with open(kubectl_state) as state:
+            names.extend(key.split('/')[2] for key in json.load(state) if key.split('/')[1] == namespace)
+    return sorted(names)
+
+
+def check(label, params, result, objects):
+    """Return what is wrong with the result of a scenario, given the objects left in its namespace."""
+    if label == 'create' and not objects:
+        return 'no object created'
+    if label == 'unchanged' and result.get('changed'):
+        # kubectl reports every object as serverside-applied, see the server_side option
+        if not (params['engine'] == 'kubectl' and params.get('server_side')
+                and params.get('fingerprint', 'none') == 'none'):
+            return 'reported changed: %s' % result['msg']
+    if label == 'exists' and result['msg'] != 'True':
+        return 'did not find the objects: %s' % result['msg']
+    if label.startswith('delete') and objects:
+        return 'left %s' % ', '.join(objects)
+    return None
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as log:
+        return sum(1 for _ in log)
+
+
+def benchmark(args):
+    kube = load_module()
+    workdir = tempfile.mkdtemp(prefix='kube-benchmark-')
+    kubectl_log = os.path.join(workdir, 'kubectl.log')
+    os.environ['FAKE_KUBECTL_LOG'] = kubectl_log
+    os.environ['FAKE_KUBECTL_LATENCY'] = str(args.kubectl_latency)
+    server = fake_api_server(args.api_latency)
+
+    other_key = other_namespace_object(server)
+    other = copy.deepcopy(server.objects[other_key])
+
+    rows = []
+    for size in args.sizes:
+        manifests = os.path.join(workdir, 'manifests-%d' % size)
+        write_manifests(manifests, size)
+        for engine in args.engines:
+            samples = dict((label, []) for label, _ in SCENARIO)
+            for repeat in range(args.repeat):
+                state_dir = os.path.join(workdir, '%s-%d-%d' % (engine, size, repeat))
+                kubectl_state = os.path.join(state_dir, 'kubectl-state.json')
+                os.makedirs(state_dir)
+                os.environ['FAKE_KUBECTL_STATE'] = kubectl_state
+                with open(kubectl_state, 'w') as state:
+                    json.dump({'ConfigMap/%s/bench-000' % OTHER_NAMESPACE: other}, state)
+                params = dict(filename=[manifests], engine=engine, namespace='default',
+                              kubectl=FAKE_KUBECTL, server='http://127.0.0.1:%d' % server.server_port,
+                              fingerprint_file=os.path.join(state_dir, 'fingerprints.json'),
+                              checkpoint_file=os.path.join(state_dir, 'checkpoints.json'),
+                              cache_dir=os.path.join(state_dir, 'cache'))
+                params.update(args.args)
+                for label, scenario in SCENARIO:
+                    processes, requests = count_lines(kubectl_log), server.requests
+                    start = time.time()
+                    result = run_module(kube, dict(params, **scenario))
+                    seconds = time.time() - start
+                    if result.get('failed'):
+                        sys.exit('%s %s with %d manifests failed: %s' % (engine, label, size, result['msg']))
+                    error = check(label, params, result, namespace_objects(server, kubectl_state, 'default'))
+                    if error:
+                        sys.exit('%s %s with %d manifests %s' % (engine, label, size, error))
+                    if namespace_objects(server, kubectl_state, OTHER_NAMESPACE) != ['bench-000'] * 2 \
+                            or server.objects.get(other_key) != other:
+                        sys.exit('%s %s with %d manifests changed %s/%s' % (
+                            engine, label, size, OTHER_NAMESPACE, other['metadata']['name']))
+                    samples[label].append(dict(seconds=seconds,
+                                               processes=count_lines(kubectl_log) - processes,
+                                               requests=server.requests - requests))
+            for label, _ in SCENARIO:
+                seconds = statistics.median(s['seconds'] for s in samples[label])
+                rows.append(dict(engine=engine, state=label, manifests=size, seconds=round(seconds, 4),
+                                 processes=samples[label][-1]['processes'],
+                                 requests=samples[label][-1]['requests'],
+                                 objects_per_second=round(size / seconds, 1)))
+    server.shutdown()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the kube module against fake-kubectl '
+                                                 'and a fake API server')
+    parser.add_argument('--engines', default='kubectl,api', type=lambda v: v.split(','),
+                        help='comma separated engines to benchmark')
+    parser.add_argument('--sizes', default='1,10,100', type=lambda v: [int(s) for s in v.split(',')],
+                        help='comma separated numbers of manifests')
+    parser.add_argument('--kubectl-latency', default=0.05, type=float,
+                        help='seconds each fake kubectl process takes')
+    parser.add_argument('--api-latency', default=0.002, type=float,
+                        help='seconds each fake API request takes')
+    parser.add_argument('--repeat', default=3, type=int, help='runs of each scenario, the median is reported')
+    parser.add_argument('--args', default={}, type=json.loads,
+                        help='extra module parameters as JSON, for instance {"phased": true}')
+    parser.add_argument('--json', help='also write the results to this file as JSON')
+    args = parser.parse_args()
+
+    rows = benchmark(args)
+
+    columns = ['engine', 'state', 'manifests', 'seconds', 'processes', 'requests', 'objects_per_second']
+    print(' '.join('%-18s' % c for c in columns))
+    for row in rows:
+        print(' '.join('%-18s' % row[c] for c in columns))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(dict(args=dict(vars(args)), results=rows), output, indent=2)
+
+
+if __name__ == '__main__':
+    main()